@@ -48,7 +48,9 @@ class Args:
                             required=True,
                             choices=['run-experiment',
                                      'build-dataset',
-                                     'output-dataset'],
+                                     'output-dataset',
+                                     'extract-features',
+                                     'build-image-store'],
                             )
         parser.add_argument('--task', required=True,
                             choices=['GQA', 'CLEVR', 'CUB'])
@@ -84,6 +86,10 @@ class Args:
                             help='-1 if no manual random seed is set')
         parser.add_argument('--curriculum_training', type=int, default=0)
         parser.add_argument('--num_workers', default=0, type=int)
+        parser.add_argument('--group_by_image', default=1, type=int,
+                            help='max number of questions on the same image '
+                            'to be placed in a batch together, '
+                            '1 for plain shuffling')
         parser.add_argument('--balance_classification', action='store_true')
 
         # model-related options
@@ -194,10 +200,68 @@ class Args:
         parser.add_argument('--metaconcept_hidden_dim', type=int, default=10)
         parser.add_argument('--hidden_dim', type=int, default=100)
         parser.add_argument('--fix_resnet', action='store_true')
+        parser.add_argument('--object_cache', default=0, type=int,
+                            help='if positive, num of images whose object '
+                            'features are cached in memory out of training')
+        parser.add_argument('--object_cache_spill', action='store_true',
+                            help='spilling object features evicted from '
+                            'the memory to disk')
+        parser.add_argument('--export_dir', default='', type=str,
+                            help='if given, exporting the model and parser '
+                            'for inference to this directory instead of '
+                            'training')
+        parser.add_argument('--export_onnx', action='store_true',
+                            help='also exporting the vision parts as ONNX')
+        parser.add_argument('--quantize_int8', action='store_true',
+                            help='quantizing the model to int8 for cpu '
+                            'inference and reporting the accuracy change on '
+                            'val and test, instead of training')
+        parser.add_argument('--calibration_size', default=64, type=int,
+                            help='num of images to calibrate the int8 '
+                            'activation ranges of the backbone on')
+        parser.add_argument('--feature_store', action='store_true',
+                            help='reading the frozen backbone features from '
+                            'the store built by extract-features, '
+                            'requires --fix_resnet')
+        parser.add_argument('--image_store', action='store_true',
+                            help='reading preprocessed images from the '
+                            'store built by build-image-store')
         parser.add_argument('--other_offset', default=0., type=float,
                             help='offset for logits of other concepts')
         parser.add_argument('--sample_size', default=100000, type=int,
                             help='num of sample points for intergral')
+        parser.add_argument('--intersection_method', default='riemann',
+                            choices=['riemann', 'owen', 'quadrature',
+                                     'table'],
+                            help='how the half-Gaussian intersection is '
+                            'integrated')
+        parser.add_argument('--intersection_nodes', default=16, type=int,
+                            help='num of quadrature nodes for the '
+                            'closed-form / quadrature intersection')
+        parser.add_argument('--quadrature_tolerance', default=0, type=float,
+                            help='if positive, tune the quadrature nodes '
+                            'every epoch for this error on ln Pr')
+        parser.add_argument('--table_max_norm', default=10, type=float,
+                            help='norm range of the intersection table')
+        parser.add_argument('--table_shape', default=[101, 129], type=int,
+                            nargs=2,
+                            help='num of grid points on norms and angles '
+                            'of the intersection table')
+        parser.add_argument('--memory_budget', default=0, type=int,
+                            help='if positive, memory in MB for each tile '
+                            'of the riemann intersection')
+        parser.add_argument('--grid_precision', default='full',
+                            choices=['full', 'float16'],
+                            help='precision of the sample grid in the '
+                            'riemann intersection')
+        parser.add_argument('--numerics_guard', default='sync',
+                            choices=['sync', 'off', 'sampled', 'deferred'],
+                            help='how the half-Gaussian primitives are '
+                            'checked for invalid values')
+        parser.add_argument('--guard_every', default=100, type=int,
+                            help='checking interval of the sampled guard')
+        parser.add_argument('--guard_buffer', default=16, type=int,
+                            help='num of violations kept for post-mortem')
         parser.add_argument('--detach_in_rel', action='store_true',
                             help='detach concept in relation calculation')
         parser.add_argument('--pretrained_embedding', action='store_true')
@@ -233,6 +297,9 @@ class Args:
                 torch.device(f'cuda: {i}')
                 for i in range(args.num_gpus)
             ]
+        else:
+            # falling back to the cpu backends on machines without gpus
+            args.cudas = [torch.device('cpu')]
 
         # getting group-related paths
         group = args.task
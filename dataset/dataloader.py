@@ -10,10 +10,55 @@
 # This file is part of the VCML codebase
 # Distributed under MIT license
 
-from torch.utils.data import DataLoader
+import random
+from torch.utils.data import DataLoader, Sampler
 
 
-def get_dataloader(dataset, collate_fn, args):
+class ImageGroupedBatchSampler(Sampler):
+    """
+    Shuffling questions in runs of up to `group_size` questions on the
+    same image, so that they fall into the same batch and share a single
+    pass of the backbone. Image-free questions are shuffled individually.
+    """
+
+    def __init__(self, image_ids, batch_size, group_size, null_image=None):
+        self.batch_size = batch_size
+        self.groups = {}
+        for i, image_id in enumerate(image_ids):
+            key = i if image_id == null_image else image_id
+            self.groups.setdefault(key, []).append(i)
+        self.group_size = group_size
+        self.length = len(image_ids)
+
+    def __iter__(self):
+        runs = []
+        for group in self.groups.values():
+            group = random.sample(group, len(group))
+            runs.extend(group[i: i + self.group_size]
+                        for i in range(0, len(group), self.group_size))
+        random.shuffle(runs)
+
+        indexes = [i for run in runs for i in run]
+        for i in range(0, len(indexes), self.batch_size):
+            yield indexes[i: i + self.batch_size]
+
+    def __len__(self):
+        return (self.length + self.batch_size - 1) // self.batch_size
+
+
+def get_dataloader(dataset, collate_fn, args, image_ids=None):
+
+    if image_ids is not None and args.group_by_image > 1:
+        sampler = ImageGroupedBatchSampler(
+            image_ids, args.batch_size, args.group_by_image,
+            args.null_image)
+        return DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            num_workers=args.num_workers,
+            pin_memory=False,
+            collate_fn=collate_fn,
+        )
 
     kwargs = {'num_workers': args.num_workers,
               'drop_last': False,
@@ -94,8 +94,10 @@ class AgentDataset(torch.utils.data.Dataset):
         return output
 
     def get_dataloader(self):
+        image_ids = [self.base_questions[ind]['image_id']
+                     for ind in self.indexes]
         return get_dataloader(
-            self, self.base_dataset.collate_fn, self.args)
+            self, self.base_dataset.collate_fn, self.args, image_ids)
 
     def load_indexes(self, indexes):
         if not isinstance(indexes, list):
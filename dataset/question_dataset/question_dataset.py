@@ -103,8 +103,10 @@ class Dataset(torch.utils.data.Dataset):
             'confidence': {'type': 'list', 'tensor': False},
 
             'plain': {'type': 'list', 'tensor': False},
-            'feature': {'type': 'concat', 'axis': 0, 'tensor': True},
-            'image': {'type': 'stack', 'tensor': True},
+            'feature': {'type': 'stack', 'tensor': True,
+                        'skip_none': True, 'unique_by': 'image_id'},
+            'image': {'type': 'stack', 'tensor': True,
+                      'skip_none': True, 'unique_by': 'image_id'},
             'objects': {'type': 'concat', 'axis': 0, 'tensor': True},
             'object_length': {'type': 'stack', 'tensor': True},
         }
@@ -25,6 +25,11 @@ from utility.common import to_tensor
 'list':
     doing nothing but link the batch as a list, tensorizing them if required
 
+With 'skip_none', None items are left out of the batch, and the indexes of
+the remaining ones are given as '<key>_indexes'.
+With 'unique_by', items sharing the same value on another key are collated
+only once, and '<key>_rows' gives the collated row of each item (None for
+skipped ones).
 '''
 
 
@@ -69,6 +74,28 @@ def pad_stack(data, setting):
     return result
 
 
+def unique_items(datas, k, setting, output):
+    skip_none = setting.get('skip_none', False)
+    if 'unique_by' in setting:
+        ids = datas[setting['unique_by']]
+    else:
+        ids = list(range(len(datas[k])))
+
+    indexes, rows, id_to_row = [], [], {}
+    for i, item in enumerate(datas[k]):
+        if skip_none and item is None:
+            rows.append(None)
+            continue
+        if ids[i] not in id_to_row:
+            id_to_row[ids[i]] = len(indexes)
+            indexes.append(i)
+        rows.append(id_to_row[ids[i]])
+
+    output[k + '_indexes'] = indexes
+    output[k + '_rows'] = rows
+    return [datas[k][i] for i in indexes]
+
+
 class collateFn:
     def __init__(self, setting):
         self.setting = setting
@@ -89,6 +116,8 @@ class collateFn:
         datas = {k: [data.get(k, None) for data in datas] for k in keys}
         for k in keys:
             setting_k = setting[k]
+            if setting_k.get('skip_none', False) or 'unique_by' in setting_k:
+                datas[k] = unique_items(datas, k, setting_k, output)
 
             if setting_k['type'] == 'stack':
                 result = np.array(datas[k])
@@ -78,6 +78,12 @@ class AgentDataset(torch.utils.data.Dataset):
     def set_inputs(self, inputs):
         self.base_dataset.set_inputs(inputs)
 
+    def init_cache(self, *arg, **kwarg):
+        self.base_dataset.init_cache(*arg, **kwarg)
+
+    def init_image_store(self, *arg, **kwarg):
+        self.base_dataset.init_image_store(*arg, **kwarg)
+
     def __contains__(self, query):
         return query in self.indexes_set
 
@@ -21,6 +21,7 @@ from PIL import Image
 from tqdm import tqdm
 import h5py as h5
 
+from utility.common import make_parent_dir
 from .utils.image_transforms import SquarePad
 from .utils import image_utils
 from .agent_visual_dataset import AgentDataset
@@ -36,6 +37,7 @@ class Dataset(torch.utils.data.Dataset):
         'plain',
         'detection',
         'image',
+        'feature',
         'ground-truth',
     ]
 
@@ -49,6 +51,8 @@ class Dataset(torch.utils.data.Dataset):
 
         self.set_inputs(['plain'])
         self.set_obj_prior(True)
+        self.store_files = {}
+        self.image_store_filename = None
 
     def match_images(self, image_dir):
         match_images(self.sceneGraphs, image_dir, self.logger)
@@ -68,14 +72,23 @@ class Dataset(torch.utils.data.Dataset):
         if 'ground-truth' in self.inputs:
             output['object_length'] = len(scene['objects'])
 
-        if 'image' in self.inputs:
+        if 'image' in self.inputs or 'feature' in self.inputs:
+            # image-free scenes carry no image at all,
+            # and are skipped in collation and by the backbone
             if filename == self.args.null_image+'.jpg':
-                scale = self.args.image_scale
-                image_transformed = np.zeros((3, scale, scale))
-                ori_shape = (scale, scale)
+                image_transformed = None
+            elif 'feature' in self.inputs:
+                # backbone features from the feature store instead of pixels
+                image_transformed, ori_shape, processed = \
+                    self.read_cache(scene['image_id'])
+                if not processed:
+                    raise Exception(
+                        f'image not in the feature store: {filename}')
             else:
-                image_transformed, ori_shape = self.read_image(filename)
-            output['image'] = image_transformed
+                image_transformed, ori_shape = self.read_image(
+                    filename, scene['image_id'])
+            key = 'feature' if 'feature' in self.inputs else 'image'
+            output[key] = image_transformed
 
             if 'detection' in self.inputs:
                 if filename == self.args.null_image+'.jpg':
@@ -92,73 +105,156 @@ class Dataset(torch.utils.data.Dataset):
 
         return output
 
-    def init_cache(self, cache_dir, main, logger):
-        self.cache_filename = os.path.join(
-            cache_dir, f'{self.args.task}_processed_images_{self.index}.h5'
-        )
-
-        if not os.path.exists(self.cache_filename):
-            self.image_ids = list(set([
-                scene['image_id'] for scene in
-                self.sceneGraphs.values()]))
-            num = len(self.image_ids)
-            scale = self.args.image_scale
-
-            with h5.File(self.cache_filename, 'w') as cache_file:
-                cache_file.create_dataset(
-                    'images',
-                    shape=(len(self.sceneGraphs), 3, scale, scale),
-                    dtype=float,
-                )
-                cache_file.create_dataset(
-                    'image_ids',
-                    data=np.array(self.image_ids, dtype='S'),
-                )
-                cache_file.create_dataset(
-                    'image_sizes',
-                    data=np.zeros(shape=(num, 2), dtype=int)
-                )
-                cache_file.create_dataset(
-                    'processed',
-                    data=np.zeros(num, dtype=int)
-                )
-
-        self.cache_file = h5.File(
-            self.cache_filename, 'r+')
-        self.image_ids = self.cache_file['image_ids'][:].astype('U')
-        self.cache_image_index = dict(zip(
-            self.image_ids,
-            range(len(self.image_ids))
+    def create_store(self, filename, key, shape, dtype):
+        """
+        Creating an empty h5 store of per-image arrays for all images, keyed
+        by image id, with one chunk per image
+        """
+        image_ids = sorted(set(
+            str(scene['image_id']) for scene in
+            self.sceneGraphs.values()))
+        num = len(image_ids)
+        make_parent_dir(filename)
+
+        with h5.File(filename, 'w') as store:
+            store.create_dataset(
+                key,
+                shape=(num,) + tuple(shape),
+                chunks=(1,) + tuple(shape),
+                dtype=dtype,
+            )
+            store.create_dataset(
+                'image_ids',
+                data=np.array(image_ids, dtype='S'),
+            )
+            store.create_dataset(
+                'image_sizes',
+                data=np.zeros(shape=(num, 2), dtype=int)
+            )
+            store.create_dataset(
+                'processed',
+                data=np.zeros(num, dtype=int)
+            )
+
+    def index_store(self, filename):
+        if not os.path.exists(filename):
+            raise Exception(f'store not found: {filename}')
+        with h5.File(filename, 'r') as store:
+            image_ids = store['image_ids'][:].astype('U')
+        return dict(zip(
+            image_ids,
+            range(len(image_ids))
         ))
 
-    def read_cache(self, image_id):
-        index = self.cache_image_index[image_id]
-        processed = self.cache_file['processed'][index]
+    def open_store(self, filename, mode='r'):
+        # h5 handles can not be shared with forked data-loading workers
+        store, pid = self.store_files.get(filename, (None, None))
+        if store is None or pid != os.getpid() or store.mode != mode:
+            if store is not None and pid == os.getpid():
+                store.close()
+            store = h5.File(filename, mode)
+            self.store_files[filename] = (store, os.getpid())
+        return store
+
+    def read_store(self, filename, store_index, key, image_id):
+        index = store_index[str(image_id)]
+        store = self.open_store(filename, 'r')
+        processed = store['processed'][index]
         if processed == 1:
-            image = self.cache_file['images'][index]
-            size = self.cache_file['image_sizes'][index]
+            item = store[key][index]
+            size = tuple(store['image_sizes'][index])
         else:
-            image = None
+            item = None
             size = None
-        return image, size, processed
+        return item, size, processed
+
+    def save_store(self, filename, store_index, key, image_id, item, size):
+        index = store_index[str(image_id)]
+        store = self.open_store(filename, 'r+')
+        store['processed'][index] = 1
+        store[key][index] = item
+        store['image_sizes'][index] = size
+
+    def init_cache(self, cache_filename, feature_shape=None):
+        """
+        Opening the feature store of backbone outputs, keyed by image id.
+        When feature_shape is given, an empty store for all images is
+        created if not existing yet.
+        """
+        if feature_shape is not None and not os.path.exists(cache_filename):
+            self.create_store(
+                cache_filename, 'features', feature_shape, np.float16)
+        self.cache_filename = cache_filename
+        self.cache_image_index = self.index_store(cache_filename)
+
+    def open_cache(self, mode='r'):
+        return self.open_store(self.cache_filename, mode)
 
-    def save_cache(self, image_id, image, size):
-        index = self.cache_image_index[image_id]
-        self.cache_file['processed'][index] = 1
-        self.cache_file['images'][index] = image
-        self.cache_file['image_sizes'][index] = size
-
-    def read_image(self, filename):
+    def read_cache(self, image_id):
+        return self.read_store(
+            self.cache_filename, self.cache_image_index, 'features',
+            image_id)
+
+    def save_cache(self, image_id, feature, size):
+        self.save_store(
+            self.cache_filename, self.cache_image_index, 'features',
+            image_id, feature, size)
+
+    def init_image_store(self, store_filename, create=False):
+        """
+        Opening the store of square-padded and resized uint8 images, keyed by
+        image id. With create=True, an empty store for all images is created
+        if not existing yet.
+        """
+        if create and not os.path.exists(store_filename):
+            scale = self.args.image_scale
+            self.create_store(
+                store_filename, 'images', (3, scale, scale), np.uint8)
+        self.image_store_filename = store_filename
+        self.image_store_index = self.index_store(store_filename)
+
+    def read_image_store(self, image_id):
+        return self.read_store(
+            self.image_store_filename, self.image_store_index, 'images',
+            image_id)
+
+    def save_image_store(self, image_id, image, size):
+        self.save_store(
+            self.image_store_filename, self.image_store_index, 'images',
+            image_id, image, size)
+
+    def load_image(self, filename):
+        """
+        Decoding, square-padding and resizing an image
+
+        Output:
+            image: uint8 array, shape = (3, image_scale, image_scale)
+            shape: the (width, height) of the original image
+        """
         if not os.path.exists(filename):
             filename = os.path.join(self.image_dir, filename)
         image = Image.open(filename).convert('RGB')
         shape = image.size
         image = np.array(self.transform_pipeline(image)).transpose(2, 0, 1)
+        return image, shape
+
+    def read_image(self, filename, image_id=None):
+        """
+        Reading an image from the image store if it is there, or decoding it
+        otherwise, and normalizing it
+        """
+        image = None
+        if self.image_store_filename is not None and \
+                str(image_id) in self.image_store_index:
+            image, shape, _ = self.read_image_store(image_id)
+        if image is None:
+            image, shape = self.load_image(filename)
 
         # normalizing
-        mean = np.array([0.485, 0.456, 0.406]).reshape(3, 1, 1)
-        std = np.array([0.229, 0.224, 0.224]).reshape(3, 1, 1)
-        image = (image / 255.0 - mean) * std
+        mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+        std = np.array([0.229, 0.224, 0.224], dtype=np.float32)
+        image = (image.astype(np.float32) / 255 - mean[:, None, None]) * \
+            std[:, None, None]
 
         return image, shape
 
@@ -53,10 +53,8 @@ class GRUModel(nn.Module):
     def build(self):
 
         if self.use_vision:
-            import jactorch.models.vision.resnet as resnet
-            self.resnet = resnet.resnet34(
-                pretrained=True, incl_gap=False, num_classes=None)
-            self.resnet.layer4 = jacnn.Identity()
+            from models.nn.scene_graph import build_trunk
+            self.resnet = build_trunk()
 
             self.mlp = jacnn.MLPLayer(
                 256 + 128 * 2,
@@ -147,6 +145,13 @@ class GRUModel(nn.Module):
         super().eval()
         self.use_lm = False
 
+    @property
+    def trunk(self):
+        return self.resnet if self.use_vision else None
+
+    def set_trunk(self, trunk):
+        self.resnet = trunk
+
     def encode_sentence(self, sent, sent_length):
         f = self.embedding(sent)
         return self.gru(f, sent_length)
@@ -154,7 +159,6 @@ class GRUModel(nn.Module):
     def forward(self, data):
         # pre-processing
         batch_size = data['batch_size']
-        data['image'] = data['image'].to(self.device)
         data['question'] = data['question_encoded'].long().to(self.device)
         questions = data['question']
         answers = torch.stack(data['answer_encoded']).to(self.device)
@@ -177,8 +181,22 @@ class GRUModel(nn.Module):
 
         # visual phase
         if self.use_vision:
-            features = self.resnet(data['image'])
-            features = features.mean(dim=-1).mean(dim=-1)
+            # each unique image runs once, and fans out to its questions;
+            # image-free samples are not collated, and keep zero features
+            key = 'feature' if 'feature' in data else 'image'
+            image_rows = data.get(f'{key}_rows', list(range(batch_size)))
+            with_image = [i for i in range(batch_size)
+                          if image_rows[i] is not None]
+            features = last_state.new_zeros(batch_size, 256)
+            if len(with_image) > 0:
+                if key == 'feature':
+                    image_features = data['feature'].to(self.device).float()
+                else:
+                    image_features = self.resnet(
+                        data['image'].to(self.device))
+                image_features = image_features.mean(dim=-1).mean(dim=-1)
+                features[with_image] = image_features[
+                    [image_rows[i] for i in with_image]]
             features = features * (1 - is_conceptual).unsqueeze(-1)
             logits = self.mlp(torch.cat([features, last_state], dim=-1))
         else:
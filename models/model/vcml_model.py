@@ -10,11 +10,13 @@
 # This file is part of the VCML codebase
 # Distributed under MIT license
 
+import atexit
+import tempfile
 import torch.nn as nn
 import torch.optim as optim
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 
-from models.nn.scene_graph import ResNetSceneGraph
+from models.nn.scene_graph import ResNetSceneGraph, ObjectCache
 from models.nn.framework import reasoning, embedding
 
 from utility.common import detach
@@ -49,6 +51,16 @@ class VCML_Model(nn.Module):
         self.feature_mlp = self.sub_net(
             args.feature_dim, args.hidden_dim, args.embed_dim)
 
+        # scene graphs are cached against the version of vision parameters,
+        # which moves on every update of them
+        self.vision_version = 0
+        self.object_cache = None
+        if args.object_cache > 0:
+            spill_dir = tempfile.mkdtemp(prefix='vcml_object_cache_') \
+                if args.object_cache_spill else None
+            self.object_cache = ObjectCache(args.object_cache, spill_dir)
+            atexit.register(self.object_cache.close)
+
     def sub_net(self, in_dim, hidden_dim, out_dim):
         if hidden_dim != 0:
             net = nn.Sequential(
@@ -88,34 +100,38 @@ class VCML_Model(nn.Module):
             program_encoded = data['program_parsed_encoded']
 
         objects = self.process_objects(data)
+        batch_logits = self.embedding.calculate_batch_logits(
+            objects,
+            [program_encoded[i][:, 1] for i in range(batch_size)],
+        )
 
-        # running
+        # executing all visual programs at once
+        visual = [i for i in range(batch_size)
+                  if data['type'][i] != 'classification']
+        results = dict(zip(visual, self.reasoning.forward_batch(
+            [program[i] for i in visual],
+            [data['answer'][i] for i in visual],
+            [data['category'][i] for i in visual],
+            [objects[i] for i in visual],
+            [batch_logits[i] for i in visual],
+            self.embedding,
+        )))
+
+        # classifying all at once
+        classification = [i for i in range(batch_size)
+                          if data['type'][i] == 'classification']
+        if len(classification) > 0:
+            results.update(zip(
+                classification, self.classify.forward_batch(
+                    [batch_logits[i] for i in classification],
+                    [data['answer_encoded'][i] for i in classification],
+                )))
+
+        # collecting
         losses, outputs, debugs = [], [], []
         for i in range(batch_size):
             debug = {}
-
-            logits = self.embedding.calculate_logits(
-                objects[i],
-                program_encoded[i][:, 1],
-            )
-            if data['type'][i] == 'classification':
-                piece_result = self.classify(
-                    logits,
-                    data['answer_encoded'][i],
-                    program_encoded[i][:, 1],
-                )
-            else:
-                try:
-                    piece_result = self.reasoning(
-                        program[i],
-                        data['answer'][i], data['category'][i],
-                        objects[i], logits,
-                        self.embedding,
-                    )
-                except Exception:
-                    piece_result = (0, {'yes': 0.5, 'no': 0.5}, {})
-
-            loss, output, this_debug = piece_result
+            loss, output, this_debug = results[i]
             debug.update(this_debug)
 
             losses.append(loss)
@@ -126,17 +142,28 @@ class VCML_Model(nn.Module):
 
     # getting object features
     def process_objects(self, data):
-        def feature_mlp(feature):
-            if feature is None:
-                return None
-            else:
-                return self.feature_mlp(feature)
-
-        _, _, recognized = self.resnet_model(data)
-        objects = [
-            feature_mlp(feature[1])
-            for feature in recognized
-        ]
+        """
+        The questions on the same image share its scene graph (see
+        ResNetSceneGraph.forward), and so the feature_mlp output of it,
+        which is calculated once per scene graph.
+        """
+        # purely conceptual batches never touch the backbone
+        if all(length == 0 for length in data['object_length']):
+            return [None] * data['batch_size']
+
+        if self.object_cache is not None:
+            self.object_cache.validate(self.vision_version)
+        _, _, recognized = self.resnet_model(data, self.object_cache)
+
+        transformed = {}
+        objects = []
+        for feature in recognized:
+            if feature[1] is None:
+                objects.append(None)
+                continue
+            if id(feature[1]) not in transformed:
+                transformed[id(feature[1])] = self.feature_mlp(feature[1])
+            objects.append(transformed[id(feature[1])])
 
         return objects
 
@@ -150,6 +177,14 @@ class VCML_Model(nn.Module):
     def set_coach(self, coach):
         self.coach = coach
 
+    @property
+    def trunk(self):
+        return self.resnet_model.resnet
+
+    def set_trunk(self, trunk):
+        self.resnet_model.resnet = trunk
+        self.vision_version += 1
+
     @property
     def max_len(self):
         output = detach(
@@ -161,8 +196,19 @@ class VCML_Model(nn.Module):
     def visualize(self, path, plt):
         self.embedding.visualize(path, plt)
 
+    def tune_intersection(self, tolerance):
+        return self.embedding.tune_intersection(tolerance)
+
+    def precision_report(self):
+        return self.embedding.precision_report()
+
     def penalty(self):
         return self.embedding.penalty()
 
+    def load_state_dict(self, *arg, **kwarg):
+        self.vision_version += 1
+        return super().load_state_dict(*arg, **kwarg)
+
     def update(self):
-        pass
+        if not self.args.fix_resnet:
+            self.vision_version += 1
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# An on-disk cache of frozen BERT encodings of concept phrases
+
+import os
+import hashlib
+import torch
+
+from utility.common import make_parent_dir
+
+
+def checkpoint_hash(model):
+    """
+    A hash of all parameters and buffers of the model
+    """
+    sha = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+def cache_filename(cache_dir, model):
+    return os.path.join(
+        cache_dir, f'bert_encodings_{checkpoint_hash(model)}.pth')
+
+
+def load_encodings(filename):
+    """
+    Output:
+        a dict from phrases to their encodings, empty if not cached yet
+    """
+    if not os.path.exists(filename):
+        return {}
+    return torch.load(filename, map_location='cpu')
+
+
+def save_encodings(filename, encodings):
+    make_parent_dir(filename)
+    temp_filename = f'{filename}.{os.getpid()}.tmp'
+    torch.save(encodings, temp_filename)
+    os.replace(temp_filename, filename)
+
+
+def encode_phrases(tokenizer, bert, phrases, device, batch_size=256):
+    """
+    Running the frozen BERT on batches of padded phrases,
+    taking the pooled output as in a single-phrase call
+
+    Output:
+        Tensor, shape = (n_phrases, bert_dim), on cpu
+    """
+    outputs = []
+    with torch.no_grad():
+        for i in range(0, len(phrases), batch_size):
+            tokens = [tokenizer.encode(phrase)
+                      for phrase in phrases[i: i + batch_size]]
+            length = max(len(one) for one in tokens)
+            input_ids = torch.LongTensor([
+                one + [tokenizer.pad_token_id] * (length - len(one))
+                for one in tokens
+            ]).to(device)
+            attention_mask = torch.LongTensor([
+                [1] * len(one) + [0] * (length - len(one))
+                for one in tokens
+            ]).to(device)
+            _, pooled = bert(input_ids, attention_mask=attention_mask)[:2]
+            outputs.append(pooled.cpu())
+    return torch.cat(outputs)
@@ -17,10 +17,26 @@ import torch.nn.init as init
 
 from utility.common import detach, matrix_dict, to_normalized
 
-from .functional import HalfGaussianConditionalLogit, logit_ln
+from .functional import HalfGaussianConditionalLogit, logit_ln, \
+    get_LnIntersection_owen
+from .intersection_table import load_intersection_table
+from . import bert_cache
 from ...visualize import visualize_sets_v2 as visualize
 
 
+# upper limit of the half-Gaussian integrals
+MAX_VALUE = 400
+
+
+def load_table(args, device):
+    return load_intersection_table(
+        args.cache_dir, args.table_max_norm, args.table_shape,
+        args.intersection_nodes,
+        get_LnIntersection_owen(args.intersection_nodes, 'cpu', True),
+        device,
+    )
+
+
 class ConceptEmbedding(nn.Module):
     def __init__(self, args, tools, device, version):
         super().__init__()
@@ -38,6 +54,7 @@ class ConceptEmbedding(nn.Module):
                 'get_concept_embeddings',
                 'get_all_concept_embeddings',
                 'get_metaconcept_net',
+                'get_paired_metaconcept_net',
                 'get_logit_fn',
                 'get_train',
                 'get_visualize',
@@ -49,6 +66,7 @@ class ConceptEmbedding(nn.Module):
                 [self.get_concept_embeddings,
                  lambda: self.get_all_concept_embeddings,
                  self.get_metaconcept_net_v0,
+                 lambda: self.paired_relation_net_v0,
                  self.get_feasible_fn,
                  self.get_train,
                  self.get_visualize_v0,
@@ -60,6 +78,7 @@ class ConceptEmbedding(nn.Module):
                  lambda: self.get_all_concept_embeddings,
                  self.get_metaconcept_net_v1,
                  # self.get_metaconcept_net_v1_lambda,
+                 lambda: self.paired_relation_net_v1,
                  self.get_feasible_fn,
                  self.get_train,
                  self.get_visualize_v1,
@@ -70,6 +89,7 @@ class ConceptEmbedding(nn.Module):
                 [self.get_bert_embeddings,
                  lambda: self.get_all_bert_embeddings,
                  self.get_metaconcept_net_nscl,
+                 lambda: self.paired_relation_net_nscl,
                  self.get_cos_fn,
                  self.get_bert_train,
                  self.get_visualize_bert,
@@ -80,6 +100,7 @@ class ConceptEmbedding(nn.Module):
                 [self.get_concept_embeddings,
                  lambda: self.get_all_concept_embeddings,
                  self.get_metaconcept_net_nscl,
+                 lambda: self.paired_relation_net_nscl,
                  self.get_cos_fn,
                  self.get_train,
                  self.get_visualize_nscl,
@@ -103,6 +124,9 @@ class ConceptEmbedding(nn.Module):
         self.metaconcept_net = self.subfn_dict[
             self.version, 'get_metaconcept_net'
         ]()
+        self.paired_metaconcept_net = self.subfn_dict[
+            self.version, 'get_paired_metaconcept_net'
+        ]()
         self.logit_fn = self.subfn_dict[
             self.version, 'get_logit_fn'
         ]()
@@ -149,6 +173,19 @@ class ConceptEmbedding(nn.Module):
 
         return output
 
+    def determine_relation_pairs(self, concepts1, concepts2,
+                                 detach=(True, True)):
+        '''
+        determine_relation of the rows of concepts1 and concepts2 paired,
+        i.e. the diagonal of determine_relation, of shape (n, 5)
+        '''
+        if detach[0]:
+            concepts1 = concepts1.detach()
+        if detach[1]:
+            concepts2 = concepts2.detach()
+
+        return self.paired_metaconcept_net(concepts1, concepts2)
+
     # align a tensor with indexes
     @staticmethod
     def align(logits, is_concepts, n):
@@ -185,6 +222,62 @@ class ConceptEmbedding(nn.Module):
 
         return logits
 
+    def calculate_batch_logits(self, objects, programs_indexes):
+        '''
+        The same as calculate_logits on each (objects[i], programs_indexes[i])
+        pair, but calculating a single objects x concepts logit matrix for
+        the whole batch, on the union of distinct object sets and of
+        concept arguments. The similarities are row-wise independent, so the
+        results are unchanged.
+        '''
+        # distinct object sets, by identity
+        object_sets = {}
+        for one in objects:
+            if one is not None and id(one) not in object_sets:
+                object_sets[id(one)] = one
+        if len(object_sets) == 0:
+            return [(None, None) for _ in objects]
+
+        # concept arguments of all programs
+        concept_columns = {}
+        programs_concepts = []
+        for program_indexes in programs_indexes:
+            one_concepts = {}
+            for i, index in enumerate(detach(program_indexes)):
+                concept = int(self.tools.arguments_in_concepts[index])
+                if concept != -1:
+                    one_concepts[i] = concept_columns.setdefault(
+                        concept, len(concept_columns))
+            programs_concepts.append(one_concepts)
+
+        all_objects = torch.cat(list(object_sets.values()))
+        offsets, start = {}, 0
+        for key, one in object_sets.items():
+            offsets[key] = (start, start + one.shape[0])
+            start += one.shape[0]
+
+        if len(concept_columns) > 0:
+            concepts_used = self.concept_embedding(
+                torch.LongTensor(list(concept_columns)).to(self.device))
+            batch_logits = self.logit_fn(all_objects, concepts_used)
+        else:
+            batch_logits = all_objects.new_zeros(all_objects.shape[0], 0)
+
+        outputs = []
+        for one, program_indexes, one_concepts in zip(
+                objects, programs_indexes, programs_concepts):
+            if one is None:
+                outputs.append((None, None))
+                continue
+            start, end = offsets[id(one)]
+            logits = batch_logits[start: end]
+            outputs.append([
+                logits[:, one_concepts[i]] if i in one_concepts else None
+                for i in range(program_indexes.shape[0])
+            ])
+
+        return outputs
+
     def get_concept_embeddings(self):
         return nn.Embedding(
             self.tools.n_concepts, self.concept_embed_dim
@@ -197,22 +290,38 @@ class ConceptEmbedding(nn.Module):
         _, self.bert_dim = \
             self.bert.embeddings.position_embeddings.weight.shape
         self.bert_mlp = self.sub_net(self.bert_dim, 0, self.args.embed_dim)
+        self.bert_encodings = None
         return self.bert_embed
 
     def bert_embed(self, concepts_indexes):
         shape = concepts_indexes.shape
         flattened = concepts_indexes.flatten()
-        concepts = [self.tools.concepts[int(index)] for index in flattened]
-        embeddings = [self.bert_embed_one(concept) for concept in concepts]
-        reshaped = torch.stack(embeddings).reshape(tuple(shape) + (-1,))
+        encodings = self.get_bert_encodings()[flattened]
+        embeddings = self.bert_mlp(encodings)
+        reshaped = embeddings.reshape(tuple(shape) + (-1,))
         return reshaped
 
-    def bert_embed_one(self, phrase):
-        tokens = self.tokenizer.encode(phrase)
-        tensor = torch.LongTensor(tokens).to(self.device)
-        bert_attention, last_state = self.bert(tensor[None])
-        output = self.bert_mlp(last_state)[0]
-        return output
+    def get_bert_encodings(self):
+        '''
+        The frozen BERT encodings of all concepts, shape = (n_concepts,
+        bert_dim). They are computed once and cached on disk, keyed by the
+        concept phrase and the hash of the BERT checkpoint.
+        '''
+        if self.bert_encodings is None:
+            filename = bert_cache.cache_filename(
+                self.args.cache_dir, self.bert)
+            cached = bert_cache.load_encodings(filename)
+            concepts = [self.tools.concepts[index]
+                        for index in self.tools.concepts.indexes()]
+            missing = [phrase for phrase in concepts if phrase not in cached]
+            if len(missing) > 0:
+                encoded = bert_cache.encode_phrases(
+                    self.tokenizer, self.bert, missing, self.device)
+                cached.update(zip(missing, encoded))
+                bert_cache.save_encodings(filename, cached)
+            self.bert_encodings = torch.stack(
+                [cached[phrase] for phrase in concepts]).to(self.device)
+        return self.bert_encodings
 
     def get_metaconcept_net_v0(self):
         self.metaconcept_subnet = self.sub_net(
@@ -244,8 +353,43 @@ class ConceptEmbedding(nn.Module):
         return self.relation_net_nscl
 
     def get_feasible_fn(self):
+        if self.args.intersection_method == 'table':
+            table = load_table(self.args, self.device)
+        else:
+            table = None
         return HalfGaussianConditionalLogit(
-            self.args.sample_size, 400, self.device, slack=False)
+            self.args.sample_size, MAX_VALUE, self.device, slack=False,
+            method=self.args.intersection_method,
+            n_nodes=self.args.intersection_nodes,
+            table=table,
+            memory_budget=self.args.memory_budget * 2 ** 20,
+            grid_precision=self.args.grid_precision,
+        )
+
+    def tune_intersection(self, tolerance, max_concepts=100):
+        """
+        Tuning the quadrature of the concept-wise intersections,
+        on at most `max_concepts` randomly chosen concepts.
+        """
+        if not isinstance(self.logit_fn, HalfGaussianConditionalLogit) or \
+                self.logit_fn.method != 'quadrature':
+            return None
+        concepts = self.all_concept_embeddings().detach()
+        chosen = torch.randperm(concepts.shape[0])[:max_concepts]
+        concepts = concepts[chosen.to(concepts.device)]
+        return self.logit_fn.tune(concepts, concepts, tolerance)
+
+    def precision_report(self, max_concepts=100):
+        """
+        Errors of the concept-wise conditionals against float64,
+        on at most `max_concepts` randomly chosen concepts.
+        """
+        if not isinstance(self.logit_fn, HalfGaussianConditionalLogit):
+            return None
+        concepts = self.all_concept_embeddings().detach()
+        chosen = torch.randperm(concepts.shape[0])[:max_concepts]
+        concepts = concepts[chosen.to(concepts.device)]
+        return self.logit_fn.precision_report(concepts, concepts)
 
     def get_cos_fn(self):
         '''
@@ -322,29 +466,41 @@ class ConceptEmbedding(nn.Module):
         '''
 
         # Use a NS-CL -like metaconcept net
-        c1 = concepts1[:, None]
-        c2 = concepts2[None]
-        n1 = concepts1.shape[0]
-        n2 = concepts2.shape[0]
-        abdp = torch.cat([c1.repeat(1, n2, 1),
-                          c2.repeat(n1, 1, 1),
-                          c1 - c2,
-                          c1 * c2],
-                         dim=-1)
-        return self.metaconcept_subnet(abdp)
+        return self.factorized_subnet(concepts1, concepts2)
 
     def relation_net_v1(self, concepts1, concepts2):
-        A_to_B = self.logit_fn(concepts1, concepts2)
-        B_to_A = self.logit_fn(concepts2, concepts1).t()
-        logit_lambda = logit_ln(self.logit_fn.ln_lambda(
-            concepts1, concepts2
-        ))
+        # the three terms share the marginals and the intersection
+        with self.logit_fn.memoize():
+            A_to_B = self.logit_fn(concepts1, concepts2)
+            B_to_A = self.logit_fn(concepts2, concepts1).t()
+            logit_lambda = logit_ln(self.logit_fn.ln_lambda(
+                concepts1, concepts2
+            ))
 
         tensor = torch.stack([A_to_B, B_to_A, logit_lambda], dim=2)
 
         output = self.metaconcept_subnet(tensor)
         return output
 
+    def paired_relation_net_v0(self, concepts1, concepts2):
+        return self.paired_subnet(concepts1, concepts2)
+
+    def paired_relation_net_v1(self, concepts1, concepts2):
+        logit_fn = self.logit_fn
+        ln_intersection, x, y = logit_fn.ln_intersection_pairs(
+            concepts1, concepts2)
+        ln_x = logit_fn.ln_marginal(concepts1, x)
+        ln_y = logit_fn.ln_marginal(concepts2, y)
+
+        tensor = torch.stack([
+            logit_ln(ln_intersection - ln_x, logit_fn.slack),
+            logit_ln(ln_intersection - ln_y, logit_fn.slack),
+            logit_ln(ln_intersection - ln_x - ln_y),
+        ], dim=1)
+
+        output = self.metaconcept_subnet(tensor)
+        return output
+
     def relation_net_v1_lambda(self, concepts1, concepts2):
         logit_lambda = logit_ln(self.logit_fn.ln_lambda(
             concepts1, concepts2
@@ -356,16 +512,46 @@ class ConceptEmbedding(nn.Module):
         return output
 
     def relation_net_nscl(self, concepts1, concepts2):
-        c1 = to_normalized(concepts1)[:, None]
-        c2 = to_normalized(concepts2)[None]
-        n1 = concepts1.shape[0]
-        n2 = concepts2.shape[0]
-        abdp = torch.cat([c1.repeat(1, n2, 1),
-                          c2.repeat(n1, 1, 1),
-                          c1 - c2,
-                          c1 * c2],
-                         dim=-1)
-        return self.metaconcept_subnet(abdp)
+        return self.factorized_subnet(
+            to_normalized(concepts1), to_normalized(concepts2))
+
+    def paired_relation_net_nscl(self, concepts1, concepts2):
+        return self.paired_subnet(
+            to_normalized(concepts1), to_normalized(concepts2))
+
+    def paired_subnet(self, concepts1, concepts2):
+        return self.metaconcept_subnet(torch.cat([
+            concepts1, concepts2, concepts1 - concepts2, concepts1 * concepts2
+        ], dim=1))
+
+    def factorized_subnet(self, concepts1, concepts2):
+        '''
+        Equivalent to metaconcept_subnet(torch.cat([c1, c2, c1 - c2, c1 * c2]))
+        over all pairs, with the first linear layer separated as
+            W·[a, b, a - b, a∘b] = (W1 + W3)·a + (W2 - W3)·b + W4·(a∘b)
+        so that only the Hadamard term is calculated pairwise, and no
+        (n1, n2, 4 * dim) tensor is built.
+        '''
+        net = self.metaconcept_subnet
+        if isinstance(net, nn.Sequential):
+            first, rest = net[0], net[1:]
+        else:
+            first, rest = net, None
+        w1, w2, w3, w4 = first.weight.chunk(4, dim=1)
+
+        rows = torch.matmul(concepts1, (w1 + w3).t())
+        columns = torch.matmul(concepts2, (w2 - w3).t())
+        # (n1, hidden, dim) x (dim, n2) -> (n1, n2, hidden)
+        hadamard = torch.matmul(
+            concepts1[:, None] * w4[None], concepts2.t()
+        ).permute(0, 2, 1)
+
+        output = rows[:, None] + columns[None] + hadamard
+        if first.bias is not None:
+            output = output + first.bias
+        if rest is not None:
+            output = rest(output)
+        return output
 
     def get_embedding(self, category, name):
         if category == 'concept':
@@ -15,11 +15,23 @@ import torch
 import torch.nn as nn
 import torch.autograd as autograd
 import math
+from contextlib import contextmanager
 
-from utility.common import \
-    assert_valid_value
-from .sub_functional import ln_pdf, ln_cdf, logit_ln
-from .utils import infinite  # , clamp_infinite
+from .sub_functional import ln_pdf, ln_cdf, logit_ln, \
+    gauss_legendre, ln_owen_tail
+from .utils import infinitesimal, infinite, clamp_infinite, equal_rows, \
+    pair_norms, sum_pair_grads
+from .intersection_table import lookup, ln_partials
+from .numerics import guard
+
+
+# roughly the number of (n_x, n_y, n_sample)-sized tensors alive at a time
+N_TEMPORARY = 16
+MIN_CHUNK = 1024
+# exp(-NEGLIGIBLE_LN) vanishes in a sum of order 1, even in double precision
+NEGLIGIBLE_LN = 120
+# maximum error on ln(Pr) allowed for evaluating a block in low precision
+GRID_TOLERANCE = 1e-2
 
 
 class HalfGaussianConditionalLogit(nn.Module):
@@ -34,16 +46,43 @@ class HalfGaussianConditionalLogit(nn.Module):
     Output:
         logit: Tensor, logit(Pr(y | x))
 
+    The intersection is evaluated by `method`:
+        'riemann': summing over `n_sample` points in [0, max_value]
+        'owen': closed form by Owen's T function, with `n_nodes` quadrature
+            nodes per pair
+        'quadrature': Gauss-Legendre quadrature of the integral, with
+            `n_nodes` nodes placed above max(x, y) for each pair
+        'table': interpolating from a precomputed `table`
+            (see intersection_table.py)
+    A positive `memory_budget` (in bytes) makes the 'riemann' method run
+    in tiles, see get_LnIntersection_riemann. `grid_precision` ('float16')
+    evaluates its sample grid in low precision for the pairs where the error
+    allows, keeping the accumulation in the precision of the inputs. Within
+    GRID_TOLERANCE, bfloat16 is never precise enough.
+
+    Within `memoize()`, the marginals and the intersections are computed
+    once per input tensor (pair) and reused.
     """
 
-    def __init__(self, n_sample, max_value, device, slack=False):
+    def __init__(self, n_sample, max_value, device, slack=False,
+                 method='riemann', n_nodes=16, table=None, memory_budget=0,
+                 grid_precision='full'):
         super().__init__()
         self.n_sample = n_sample
         self.max_value = max_value
         self.slack = slack
         self.device = device
+        self.method = method
+        self.n_nodes = n_nodes
+        self.table = table
+        self.memory_budget = memory_budget
+        self.grid_precision = grid_precision
+        self.error_budget = None
+        self.memo = None
         self.ln_intersection_fn = get_LnIntersection(
-            self.n_sample, self.max_value, self.device, self.slack
+            self.n_sample, self.max_value, self.device, self.slack,
+            self.method, self.n_nodes, self.table, self.memory_budget,
+            self.grid_precision,
         )
 
     def forward(self, x_vec, y_vec):
@@ -58,29 +97,195 @@ class HalfGaussianConditionalLogit(nn.Module):
         return logit_conditional
 
     def ln_conditional(self, x_vec, y_vec):
-        x = x_vec.norm(2, -1)
-        y = y_vec.norm(2, -1)
-        equal = (x_vec[:, None] - y_vec[None]).abs().sum(2) == 0
-        inner_prod = torch.matmul(x_vec, y_vec.t())
-        cos = inner_prod / x[:, None] / y[None]
-        cos[equal] = 1
-
-        ln_intersection = self.ln_intersection_fn(
-            x, y, cos,
-        )
-        ln_x = ln_cdf_by_integral(
-            -x, self.ln_intersection_fn)[:, None]
+        ln_intersection, x, y, cos = self.ln_intersection(x_vec, y_vec)
+        ln_x = self.ln_marginal(x_vec, x)[:, None]
         ln_conditional = ln_intersection - ln_x
         return ln_conditional, x, y, cos
 
     def ln_lambda(self, x_vec, y_vec):
         ln_conditional, _, y, _, = self.ln_conditional(x_vec, y_vec)
-        ln_lambda = ln_conditional - ln_cdf_by_integral(
-            -y, self.ln_intersection_fn)[None]
+        ln_lambda = ln_conditional - self.ln_marginal(y_vec, y)[None]
         return ln_lambda
 
+    def ln_intersection(self, x_vec, y_vec):
+        """
+        Output:
+            ln(Pr(X ∩ Y)), norms of x and y, and the cosine values
+            As the intersection is symmetric, a memoized result of
+            (y_vec, x_vec) is reused by transposing.
+        """
+        if self.memo is not None:
+            reverse_key = self.memo_key('intersection', y_vec, x_vec)
+            if reverse_key in self.memo:
+                ln_intersection, y, x, cos = self.memo[reverse_key][1]
+                return ln_intersection.t(), x, y, cos.t()
+
+        def calculate():
+            x = x_vec.norm(2, -1)
+            y = y_vec.norm(2, -1)
+            equal = equal_rows(x_vec, y_vec)
+            inner_prod = torch.matmul(x_vec, y_vec.t())
+            cos = inner_prod / x[:, None] / y[None]
+            cos[equal] = 1
+
+            ln_intersection = self.ln_intersection_fn(
+                x, y, cos,
+            )
+            return ln_intersection, x, y, cos
+
+        return self.cached('intersection', (x_vec, y_vec), calculate)
+
+    def ln_intersection_pairs(self, x_vec, y_vec):
+        """
+        Output:
+            ln(Pr(X ∩ Y)) of the rows of x_vec and y_vec paired, of shape
+            (n,), and the norms of x and y
+        """
+        x = x_vec.norm(2, -1)
+        y = y_vec.norm(2, -1)
+        cos = (x_vec * y_vec).sum(-1) / x / y
+        cos[(x_vec == y_vec).all(-1)] = 1
+
+        ln_intersection = self.ln_intersection_fn(
+            x[:, None], y[:, None], cos[:, None],
+        )[:, 0]
+        return ln_intersection, x, y
+
+    def ln_marginal(self, x_vec, x):
+        """
+        ln(Pr(X)), x being the norms of x_vec
+        """
+        return self.cached(
+            'marginal', (x_vec,),
+            lambda: ln_cdf_by_integral(-x, self.ln_intersection_fn)
+        )
 
-def get_LnIntersection(n_sample, max_value, device, slack):
+    @contextmanager
+    def memoize(self):
+        """
+        Caching the marginals and intersections within the context, keyed by
+        the identity and version of the input tensors. The cached outputs
+        are shared nodes in the autograd graph, so gradients from all their
+        uses are accumulated as usual. Nested contexts share the outermost
+        cache.
+        """
+        outermost = self.memo is None
+        if outermost:
+            self.memo = {}
+        try:
+            yield self
+        finally:
+            if outermost:
+                self.memo = None
+
+    @staticmethod
+    def memo_key(name, *inputs):
+        """
+        Views are keyed by their base tensor and their layout in it, so that
+        the views made on each call (e.g. x_vec[None] of 1-d inputs) share
+        the key of the tensor they are taken from
+        """
+        def key(tensor):
+            base = tensor if tensor._base is None else tensor._base
+            return (id(base), base._version, tuple(tensor.shape),
+                    tensor.stride(), tensor.storage_offset())
+
+        return (name, torch.is_grad_enabled()) + tuple(
+            key(tensor) for tensor in inputs
+        )
+
+    def cached(self, name, inputs, calculate):
+        if self.memo is None:
+            return calculate()
+        key = self.memo_key(name, *inputs)
+        if key not in self.memo:
+            # keeping the inputs (and so their bases) alive, so that their
+            # ids are not reused
+            self.memo[key] = (inputs, calculate())
+        return self.memo[key][1]
+
+    def tune(self, x_vec, y_vec, tolerance):
+        """
+        Choosing the number of quadrature nodes by the maximum absolute error
+        on ln(Pr(X ∩ Y)) of the given vectors, and on their marginals (the
+        cos == 1 case of ln_cdf_by_integral), against the dense grid of
+        n_sample points. The error of the chosen setting is kept as
+        `error_budget`, and the errors of all tried settings are returned.
+        """
+        assert self.method == 'quadrature', \
+            'only the quadrature method is tunable'
+        with torch.no_grad():
+            _, x, y, cos = self.ln_conditional(x_vec, y_vec)
+            cases = [(x, y, cos)] + [
+                (norm, norm.min()[None] / 2,
+                 torch.ones(norm.shape[0], 1, dtype=norm.dtype).to(
+                     norm.device))
+                for norm in (x, y)
+            ]
+            n_nodes, errors = tune_quadrature(
+                cases, tolerance,
+                self.n_sample, self.max_value, self.device, self.slack
+            )
+        self.n_nodes = n_nodes
+        self.error_budget = errors[n_nodes]
+        self.ln_intersection_fn = get_LnIntersection(
+            self.n_sample, self.max_value, self.device, self.slack,
+            self.method, self.n_nodes, self.table, self.memory_budget,
+            self.grid_precision,
+        )
+        return errors
+
+    def precision_report(self, x_vec, y_vec):
+        """
+        The absolute errors of ln(Pr(y | x)) against a float64 evaluation
+        on the same grid of sample points, the grid itself and all the terms
+        being evaluated in float64
+        """
+        reference = HalfGaussianConditionalLogit(
+            self.n_sample, self.max_value, self.device, self.slack,
+            memory_budget=self.memory_budget,
+        )
+        with torch.no_grad():
+            ln_conditional, x, y, cos = self.ln_conditional(x_vec, y_vec)
+            ln_reference = reference.ln_conditional(
+                x_vec.double(), y_vec.double())[0]
+            error = (ln_conditional.double() - ln_reference).abs()
+        report = {
+            'max': error.max().item(),
+            'mean': error.mean().item(),
+        }
+        if self.grid_precision != 'full':
+            report['low'] = low_precision_fraction(
+                x, y, cos, getattr(torch, self.grid_precision), self.slack)
+        return report
+
+
+def get_LnIntersection(n_sample, max_value, device, slack,
+                       method='riemann', n_nodes=16, table=None,
+                       memory_budget=0, grid_precision='full'):
+    if method == 'riemann':
+        return get_LnIntersection_riemann(
+            n_sample, max_value, device, slack, memory_budget,
+            grid_precision)
+    elif grid_precision != 'full':
+        raise Exception(f'{grid_precision} grid is only supported '
+                        'by the riemann method')
+    elif method == 'owen':
+        return get_LnIntersection_owen(n_nodes, device, slack)
+    elif method == 'quadrature':
+        return get_LnIntersection_quadrature(n_nodes, device, slack)
+    elif method == 'table':
+        return get_LnIntersection_table(table, n_nodes, device, slack)
+    else:
+        raise Exception(f'unsupported intersection method: {method}')
+
+
+def get_LnIntersection_riemann(n_sample, max_value, device, slack,
+                               memory_budget=0, grid_precision='full'):
+    if grid_precision == 'full':
+        grid_dtype = None
+    else:
+        grid_dtype = getattr(torch, grid_precision)
 
     class LnIntersection(autograd.Function):
         """
@@ -97,23 +302,39 @@ def get_LnIntersection(n_sample, max_value, device, slack):
 
         Output:
             ln(Pr), Tensor, shape = (n_x, n_y)
+
+        For n paired vectors, x, y and cos are all of shape (n, 1) instead
+        (see pair_norms).
+
+        With a positive memory_budget, the calculation is tiled instead:
+        x and y are split into blocks, and the sample points are streamed in
+        chunks, so that the (n_x, n_y, n_sample) intermediate tensors are
+        never built as a whole.
+
+        With a grid_dtype, the tiled calculation evaluates the terms of the
+        sum in grid_dtype for the pairs whose error bound (see
+        grid_error_bound) is within GRID_TOLERANCE. The sum itself is
+        accumulated in the dtype of cos.
+
+        The sample points are kept in float64, and cast to the dtype of cos.
         """
 
-        current_device = torch.cuda.current_device()
-        points = torch.linspace(0, max_value, n_sample).to(device)
+        points = torch.linspace(
+            0, max_value, n_sample, dtype=torch.double).to(device)
         c = ln_pdf(points)[None, None, :]
 
         @classmethod
         def forward_inner(cls, x, y, cos):
-            points = cls.points
-            c = cls.c
+            points = cls.points.to(cos.dtype)
+            c = cls.c.to(cos.dtype)
             delta = max_value / (n_sample - 1)
             sin = (1 - cos.pow(2)).clamp(0, 1).sqrt()
             csc = (1 / sin).clamp(0, infinite)
 
             # re-order x and y, letting x be the bigger of the two
-            x_r = torch.max(x[:, None], y[None])
-            y_r = torch.min(x[:, None], y[None])
+            x, y = pair_norms(x, y, cos)
+            x_r = torch.max(x, y)
+            y_r = torch.min(x, y)
 
             a = ln_pdf(x_r)
             b = ln_cdf(-(y_r - x_r * cos) * csc, True, slack)
@@ -128,6 +349,127 @@ def get_LnIntersection(n_sample, max_value, device, slack):
 
             return ln_Pr, a, b, c, d, e, g_uy, sin, csc
 
+        @classmethod
+        def forward_tiled(cls, x, y, cos):
+            sin = (1 - cos.pow(2)).clamp(0, 1).sqrt()
+            csc = (1 / sin).clamp(0, infinite)
+            x, y = pair_norms(x, y, cos)
+            n_x, n_y = cos.shape
+            if memory_budget > 0:
+                # sized for the pairs left in full precision
+                n_elements = memory_budget // (
+                    cos.element_size() * N_TEMPORARY)
+            else:
+                n_elements = n_x * n_y * n_sample
+            block_x, block_y, chunk = plan_tiles(
+                n_x, n_y, n_sample, n_elements)
+
+            ln_Pr = torch.zeros_like(cos)
+            for i in range(0, n_x, block_x):
+                for j in range(0, n_y, block_y):
+                    ln_Pr[i: i+block_x, j: j+block_y] = cls.forward_block(
+                        x[i: i+block_x, j: j+block_y],
+                        y[i: i+block_x, j: j+block_y],
+                        cos[i: i+block_x, j: j+block_y],
+                        sin[i: i+block_x, j: j+block_y],
+                        csc[i: i+block_x, j: j+block_y],
+                        chunk,
+                    )
+
+            return ln_Pr, sin, csc
+
+        @classmethod
+        def forward_block(cls, x, y, cos, sin, csc, chunk):
+            """
+            Summing e = exp(c + d - a - b) chunk by chunk, for the pairs
+            flattened. With a grid_dtype, the pairs within the error bound
+            (see low_precision_mask) are summed in grid_dtype.
+            """
+            delta = max_value / (n_sample - 1)
+
+            x_r = torch.max(x, y)
+            y_r = torch.min(x, y)
+
+            a = ln_pdf(x_r)
+            z = -(y_r - x_r * cos) * csc
+            b = ln_cdf(z, True, slack)
+
+            total = torch.zeros_like(cos)
+            if grid_dtype is None:
+                full = torch.ones_like(cos, dtype=torch.bool)
+            else:
+                low = low_precision_mask(b, csc, grid_dtype)
+                full = ~low
+                if low.any():
+                    total[low] = cls.sum_low_precision(
+                        x_r[low], z[low], (cos * csc)[low], b[low], chunk)
+            if full.any():
+                total[full] = cls.sum_terms(
+                    x_r[full], y_r[full], cos[full], csc[full],
+                    a[full], b[full], chunk)
+
+            ln_Pr = a + b + total.log() + math.log(delta)
+            return ln_Pr
+
+        @classmethod
+        def sample_range(cls, x_r, b):
+            """
+            The range of sample points where any of the terms may weigh in
+            the sum: above x, and where e >= exp(-NEGLIGIBLE_LN)
+            """
+            delta = max_value / (n_sample - 1)
+            # c - a <= (x^2 - u^2) / 2, d <= 0
+            u_max = (x_r.pow(2) - 2 * b + 2 * NEGLIGIBLE_LN).max().sqrt()
+            u_max = float(u_max.clamp(max=max_value))
+            start = int(x_r.min() / delta)
+            end = min(int(u_max / delta) + 2, n_sample)
+            return start, end
+
+        @classmethod
+        def sum_terms(cls, x_r, y_r, cos, csc, a, b, chunk):
+            """
+            sum(e) over the sample points, for pairs of shape (n_pairs,).
+            As e is already shifted by a + b, its first unmasked point being
+            close to 1, the running sum works as a running log-sum-exp.
+            """
+            start, end = cls.sample_range(x_r, b)
+            total = torch.zeros_like(x_r)
+            for k in range(start, end, chunk):
+                points = cls.points[k: min(k + chunk, end)].to(x_r.dtype)
+                c = cls.c[0, :, k: min(k + chunk, end)].to(x_r.dtype)
+                g_uy = (y_r[:, None] - points[None] * cos[:, None]) * \
+                    csc[:, None]
+                d = ln_cdf(-g_uy, True, slack)
+                e = (c + d - (a + b)[:, None]).exp()
+                e[points[None] <= x_r[:, None]] = 0
+                total = total + e.sum(1)
+            return total
+
+        @classmethod
+        def sum_low_precision(cls, x_r, z, cot, b, chunk):
+            """
+            sum(e) in grid_dtype, written in s = u - x, taken relative to
+            the first point u_0 of each chunk as (u_0 - x) + (u - u_0):
+                c - a = -s(2x + s) / 2
+                d = ln(Ø(z + s·cot(theta))), z = -g(x, y)
+            so that neither the large ln_pdf values nor u itself are
+            represented in low precision.
+            """
+            start, end = cls.sample_range(x_r, b)
+            x_g, z_g, cot_g, b_g = (
+                one.to(grid_dtype)[:, None] for one in (x_r, z, cot, b))
+            total = torch.zeros_like(x_r)
+            for k in range(start, end, chunk):
+                points = cls.points[k: min(k + chunk, end)]
+                u_0 = float(points[0])
+                s = (u_0 - x_r).to(grid_dtype)[:, None] + \
+                    (points - u_0).to(grid_dtype)[None]
+                d = ln_cdf(z_g + s * cot_g, True, slack)
+                e = (d - b_g - s * (2 * x_g + s) / 2).exp()
+                e[points.to(x_r.dtype)[None] <= x_r[:, None]] = 0
+                total = total + e.sum(1, dtype=total.dtype)
+            return total
+
         @staticmethod
         def forward(ctx, x, y, cos):
             """
@@ -139,6 +481,15 @@ def get_LnIntersection(n_sample, max_value, device, slack):
             In calculation, the index dimensions are in order of [x, y, u]
             """
 
+            if memory_budget > 0 or grid_dtype is not None:
+                ln_Pr, sin, csc = LnIntersection.forward_tiled(x, y, cos)
+                ctx.save_for_backward(x, y, cos, sin, csc, ln_Pr,
+                                      torch.BoolTensor([slack]))
+                if not slack:
+                    guard.check('LnIntersection.forward', ln_Pr,
+                                inputs=(x, y, cos))
+                return ln_Pr
+
             ln_Pr, a, b, c, d, e, g_uy, sin, csc = \
                 LnIntersection.forward_inner(
                     x, y, cos
@@ -148,7 +499,8 @@ def get_LnIntersection(n_sample, max_value, device, slack):
                                   torch.BoolTensor([slack]))
             if not slack:
                 try:
-                    assert_valid_value(ln_Pr)
+                    guard.check('LnIntersection.forward', ln_Pr,
+                                inputs=(x, y, cos))
                 except Exception:
                     from pprint import pprint
                     pprint((a, b, c, d, e, g_uy, ln_Pr, x, y, cos, sin, csc))
@@ -158,49 +510,356 @@ def get_LnIntersection(n_sample, max_value, device, slack):
 
         @staticmethod
         def backward(ctx, grad_output):
-            """
-            grad(ln(Pr)) = grad(Pr) / Pr
+            return ln_intersection_backward(ctx, grad_output)
 
-            For numerical stability, the log of the negative gradient is
-            calculated first, and taken exponent later e.g. grad[x](ln(Pr)) = -
-            exp(ln(grad[x](Pr)) - ln(Pr)) * grad_output
-            """
-            x, y, cos, sin, csc, ln_Pr, slack = ctx.saved_tensors
-            x = x[:, None]
-            y = y[None]
-
-            # Calculating ln_grad(ln(Pr)
-            ln_grad_x = ln_cdf((x * cos - y) * csc, True, slack) +\
-                ln_pdf(x) - ln_Pr
-            ln_grad_y = ln_cdf((y * cos - x) * csc, True, slack) +\
-                ln_pdf(y) - ln_Pr
-            ln_grad_cos = \
-                - (x.pow(2) - 2 * x * y * cos + y.pow(2)) * csc * csc / 2 \
-                + (csc / 2 / math.pi).log() - ln_Pr
-
-            # grad(ln(Pr))
-            grad_x = - ln_grad_x.exp() * grad_output
-            grad_y = - ln_grad_y.exp() * grad_output
-            grad_cos = ln_grad_cos.exp() * grad_output
-
-            # summing gradient flows
-            grad_x = grad_x.sum(1)
-            grad_y = grad_y.sum(0)
-
-            # clamping value
-            # grad_cos = clamp_infinite(grad_cos)
+    ln_intersection_fn = LnIntersection().apply
+
+    return ln_intersection_fn
+
+
+def grid_error_bound(b, grid_dtype):
+    """
+    A bound on the error of ln(Pr) when the terms of a pair are summed in
+    grid_dtype (see sum_low_precision), elementwise in b = ln(Ø(-g(x, y))).
+    For the terms that weigh in the sum, |c - a| and |d| are within
+    |b| + 1, and the error of d follows that of its argument z by
+    |d'(z)·z| <= 2|d| + 1. With each operand rounded by eps / 2, the error
+    of the exponent, and so that of ln(Pr), is at most
+        eps · (2·|b| + 2)
+    which is checked against float64 in tests/test_grid_precision.py.
+    """
+    eps = torch.finfo(grid_dtype).eps
+    return eps * (2 * b.abs() + 2)
+
+
+def low_precision_mask(b, csc, grid_dtype):
+    """
+    The pairs that can be summed in grid_dtype within GRID_TOLERANCE. The
+    pairs of nearly parallel vectors are left out, as their cot(theta)
+    overflows in grid_dtype.
+    """
+    g_max = torch.finfo(grid_dtype).max ** 0.5 / 2
+    return (grid_error_bound(b, grid_dtype) <= GRID_TOLERANCE) & \
+        (csc < g_max)
+
+
+def low_precision_fraction(x, y, cos, grid_dtype, slack=False):
+    """
+    The fraction of the (x, y) pairs summed in grid_dtype, for the norms
+    x, y and their cosines cos
+    """
+    x, y = pair_norms(x, y, cos)
+    x_r = torch.max(x, y)
+    y_r = torch.min(x, y)
+    sin = (1 - cos.pow(2)).clamp(0, 1).sqrt()
+    csc = (1 / sin).clamp(0, infinite)
+    b = ln_cdf(-(y_r - x_r * cos) * csc, True, slack)
+    return low_precision_mask(b, csc, grid_dtype).double().mean().item()
+
+
+def plan_tiles(n_x, n_y, n_sample, n_elements):
+    """
+    Choosing the block sizes on x, y and the sample axis, so that a block
+    holds no more than n_elements. Whole rows of pairs are kept if the
+    budget allows at least MIN_CHUNK samples per pair.
+    """
+    n_elements = max(n_elements, 1)
+    if n_x * n_y * min(MIN_CHUNK, n_sample) <= n_elements:
+        chunk = min(n_elements // (n_x * n_y), n_sample)
+        return n_x, n_y, chunk
+
+    chunk = min(MIN_CHUNK, n_sample, n_elements)
+    n_pairs = max(n_elements // chunk, 1)
+    block_y = min(n_y, n_pairs)
+    block_x = max(n_pairs // block_y, 1)
+    return block_x, block_y, chunk
+
+
+def ln_intersection_backward(ctx, grad_output):
+    """
+    grad(ln(Pr)) = grad(Pr) / Pr
+
+    For numerical stability, the log of the negative gradient is
+    calculated first, and taken exponent later e.g. grad[x](ln(Pr)) = -
+    exp(ln(grad[x](Pr)) - ln(Pr)) * grad_output
+    """
+    x_norms, y_norms, cos, sin, csc, ln_Pr, slack = ctx.saved_tensors
+    x, y = pair_norms(x_norms, y_norms, cos)
+
+    # Calculating ln_grad(ln(Pr)
+    ln_grad_x = ln_cdf((x * cos - y) * csc, True, slack) +\
+        ln_pdf(x) - ln_Pr
+    ln_grad_y = ln_cdf((y * cos - x) * csc, True, slack) +\
+        ln_pdf(y) - ln_Pr
+    ln_grad_cos = \
+        - (x.pow(2) - 2 * x * y * cos + y.pow(2)) * csc * csc / 2 \
+        + (csc / 2 / math.pi).log() - ln_Pr
+
+    # grad(ln(Pr))
+    grad_x = - ln_grad_x.exp() * grad_output
+    grad_y = - ln_grad_y.exp() * grad_output
+    grad_cos = ln_grad_cos.exp() * grad_output
+
+    # summing gradient flows
+    grad_x, grad_y = sum_pair_grads(grad_x, grad_y, x_norms, y_norms)
+
+    # clamping value
+    # grad_cos = clamp_infinite(grad_cos)
+    grad_cos[sin == 0] = 0
+
+    if not slack:
+        guard.check('LnIntersection.backward', grad_x, grad_y, grad_cos,
+                    assert_finite=True, inputs=(x, y, cos, grad_output))
+    return grad_x, grad_y, grad_cos
+
+
+def get_LnIntersection_owen(n_nodes, device, slack):
+
+    class LnIntersectionOwen(autograd.Function):
+        """
+        Closed-form counterpart of LnIntersection, not depending on n_sample.
+
+        Pr(X ∩ Y) is the upper orthant probability of a standard bivariate
+        normal with correlation cos(theta). By Owen's T function,
+        ln(Pr) = ln(R(x, a_x) + R(y, a_y))
+        R(h, a) = ∫[a, +∞](ø(h)·ø(h·t) / (1 + t^2)) = T(h, +∞) - T(h, a)
+        a_x = (y - x·cos(theta)) / (x·sin(theta))
+
+        Both terms are non-negative, so they are summed in log space.
+
+        Input & Output: the same as LnIntersection
+        """
+
+        nodes, weights = gauss_legendre(n_nodes, device)
+
+        @classmethod
+        def forward_inner(cls, x, y, cos):
+            nodes = cls.nodes
+            weights = cls.weights
+            sin = (1 - cos.pow(2)).clamp(0, 1).sqrt()
+            csc = (1 / sin).clamp(0, infinite)
+
+            # calculating in double precision, the output goes down to -1e30
+            x_, y_ = pair_norms(x.double().clamp(min=infinitesimal),
+                                y.double().clamp(min=infinitesimal), cos)
+            cos_ = cos.double()
+            csc_ = (1 / (1 - cos_.pow(2)).clamp(0, 1).sqrt())\
+                .clamp(0, infinite)
+            a_x = (y_ - x_ * cos_) * csc_ / x_
+            a_y = (x_ - y_ * cos_) * csc_ / y_
+
+            ln_Pr = torch.stack([
+                ln_owen_tail(x_, a_x, nodes, weights),
+                ln_owen_tail(y_, a_y, nodes, weights),
+            ]).logsumexp(0)
+            ln_Pr = clamp_infinite(ln_Pr).to(cos.dtype)
+
+            return ln_Pr, sin, csc
+
+        @staticmethod
+        def forward(ctx, x, y, cos):
+            ln_Pr, sin, csc = LnIntersectionOwen.forward_inner(x, y, cos)
+
+            ctx.save_for_backward(x, y, cos, sin, csc, ln_Pr,
+                                  torch.BoolTensor([slack]))
+            if not slack:
+                guard.check('LnIntersectionOwen.forward', ln_Pr,
+                            inputs=(x, y, cos))
+
+            return ln_Pr
+
+        @staticmethod
+        def backward(ctx, grad_output):
+            return ln_intersection_backward(ctx, grad_output)
+
+    ln_intersection_fn = LnIntersectionOwen().apply
+
+    return ln_intersection_fn
+
+
+def get_LnIntersection_quadrature(n_nodes, device, slack, ln_range=25):
+
+    class LnIntersectionQuadrature(autograd.Function):
+        """
+        Gauss-Legendre counterpart of LnIntersection.
+
+        ln(Pr) = ln(∫[x, t_max](ø(t)·Ø(-g(t, y))))
+        where x is the bigger of the two, and the integral is cut at t_max,
+        above which the integrand falls below exp(-ln_range) of its value at
+        x. The n_nodes nodes are placed on [x, t_max] for each pair:
+            t_max - x = min(√(x^2 + 2·ln_range) - x,
+                            √(2·ln_range)·sin(theta) / -cos(theta))
+        the second term only applying to cos(theta) < 0, where Ø(-g(t, y))
+        decays as well.
+
+        Input & Output: the same as LnIntersection
+        """
+
+        nodes, ln_weights = gauss_legendre(n_nodes, device)
+
+        @classmethod
+        def forward_inner(cls, x, y, cos):
+            nodes = cls.nodes.to(cos.dtype)
+            ln_weights = cls.ln_weights.to(cos.dtype)
+            sin = (1 - cos.pow(2)).clamp(0, 1).sqrt()
+            csc = (1 / sin).clamp(0, infinite)
+
+            # re-order x and y, letting x be the bigger of the two
+            x, y = pair_norms(x, y, cos)
+            x_r = torch.max(x, y)
+            y_r = torch.min(x, y)
+
+            # adapting the integral range to each pair, the second bound
+            # only applying to cos < 0 (it vanishes at cos == 1, which the
+            # marginals and identical vectors come with)
+            bound = math.sqrt(2 * ln_range) * sin / \
+                (-cos).clamp(infinitesimal, 1)
+            bound = torch.where(
+                cos < 0, bound, torch.full_like(bound, infinite))
+            width = torch.min(
+                (x_r.pow(2) + 2 * ln_range).sqrt() - x_r, bound)
+            half = width[:, :, None] / 2
+            points = x_r[:, :, None] + half * (nodes + 1)
+
+            g_uy = (y_r[:, :, None] - points * cos[:, :, None]) * \
+                csc[:, :, None]
+            ln_integrand = ln_pdf(points) + ln_cdf(-g_uy, True, slack)
+            ln_Pr = (ln_integrand + ln_weights).logsumexp(2) + \
+                half[:, :, 0].log()
+            ln_Pr = clamp_infinite(ln_Pr)
+
+            return ln_Pr, sin, csc
+
+        @staticmethod
+        def forward(ctx, x, y, cos):
+            ln_Pr, sin, csc = \
+                LnIntersectionQuadrature.forward_inner(x, y, cos)
+
+            ctx.save_for_backward(x, y, cos, sin, csc, ln_Pr,
+                                  torch.BoolTensor([slack]))
+            if not slack:
+                guard.check('LnIntersectionQuadrature.forward', ln_Pr,
+                            inputs=(x, y, cos))
+
+            return ln_Pr
+
+        @staticmethod
+        def backward(ctx, grad_output):
+            return ln_intersection_backward(ctx, grad_output)
+
+    ln_intersection_fn = LnIntersectionQuadrature().apply
+
+    return ln_intersection_fn
+
+
+def get_LnIntersection_table(table, n_nodes, device, slack):
+
+    class LnIntersectionTable(autograd.Function):
+        """
+        Table-driven counterpart of LnIntersection.
+
+        ln(Pr) and its partial derivatives are interpolated from the
+        (norm, norm, angle) grid of the table (see intersection_table.py).
+        Pairs beyond the table, or in a cell where the interpolation error
+        is beyond TABLE_TOLERANCE, are calculated by the closed form of
+        Owen's T instead.
+
+        Input & Output: the same as LnIntersection
+        """
+
+        values = table['values'].to(device)
+        exact_cells = table['exact'].to(device)
+        max_norm = table['max_norm']
+        fallback_fn = get_LnIntersection_owen(n_nodes, device, slack)
+
+        @classmethod
+        def exact(cls, x, y, cos):
+            ln_Pr = cls.fallback_fn(x, y, cos)
+            return torch.stack((ln_Pr,) + ln_partials(x, y, cos, ln_Pr))
+
+        @classmethod
+        def forward_inner(cls, x, y, cos):
+            x, y = pair_norms(x, y, cos)
+            output, exact = lookup(
+                cls.values, cls.exact_cells, cls.max_norm, x, y, cos)
+            if exact.any():
+                output[:, exact] = cls.exact(
+                    x[exact][:, None], y[exact][:, None],
+                    cos[exact][:, None])[:, :, 0]
+
+            return output
+
+        @staticmethod
+        def forward(ctx, x, y, cos):
+            output = LnIntersectionTable.forward_inner(x, y, cos)
+            ln_Pr = output[0]
+
+            ctx.save_for_backward(x, y, cos, output[1:],
+                                  torch.BoolTensor([slack]))
+            if not slack:
+                guard.check('LnIntersectionTable.forward', ln_Pr,
+                            inputs=(x, y, cos))
+
+            return ln_Pr
+
+        @staticmethod
+        def backward(ctx, grad_output):
+            x, y, cos, partials, slack = ctx.saved_tensors
+            sin = (1 - cos.pow(2)).clamp(0, 1).sqrt()
+
+            grad_x, grad_y = sum_pair_grads(
+                partials[0] * grad_output, partials[1] * grad_output, x, y)
+            # d(theta) / d(cos) = -1 / sin(theta)
+            grad_cos = - partials[2] / sin * grad_output
             grad_cos[sin == 0] = 0
 
             if not slack:
-                assert_valid_value(grad_x, grad_y, grad_cos,
-                                   assert_finite=True)
+                guard.check('LnIntersectionTable.backward',
+                            grad_x, grad_y, grad_cos, assert_finite=True,
+                            inputs=(cos, grad_output))
             return grad_x, grad_y, grad_cos
 
-    ln_intersection_fn = LnIntersection().apply
+    ln_intersection_fn = LnIntersectionTable().apply
 
     return ln_intersection_fn
 
 
+def tune_quadrature(cases, tolerance, n_sample, max_value, device, slack,
+                    candidates=(8, 12, 16, 24, 32, 48, 64)):
+    """
+    Finding the least number of quadrature nodes in `candidates`, whose
+    maximum absolute error on ln(Pr) against the dense grid is within
+    `tolerance` over all `cases`, each being an (x, y, cos) input of the
+    intersection. The largest candidate is taken if none is.
+
+    The dense grid is evaluated one row of x at a time, to keep the
+    (n_y, n_sample) intermediate tensors small.
+    """
+    reference_fn = get_LnIntersection_riemann(
+        n_sample, max_value, device, slack)
+    references = [
+        torch.cat([
+            reference_fn(x[i: i+1], y, cos[i: i+1])
+            for i in range(x.shape[0])
+        ])
+        for x, y, cos in cases
+    ]
+
+    errors = {}
+    for n_nodes in candidates:
+        ln_intersection_fn = get_LnIntersection_quadrature(
+            n_nodes, device, slack)
+        error = max(
+            (ln_intersection_fn(x, y, cos) - reference).abs().max()
+            for (x, y, cos), reference in zip(cases, references)
+        )
+        errors[n_nodes] = error.item()
+        if errors[n_nodes] <= tolerance:
+            break
+
+    return n_nodes, errors
+
+
 def ln_cdf_by_integral(mx, ln_intersection_fn):
     """
     Calculate the ln_cdf(x) by integration.
@@ -214,6 +873,6 @@ def ln_cdf_by_integral(mx, ln_intersection_fn):
     y = x.min()[None] / 2
     n_x = x.shape[0]
     output = ln_intersection_fn(
-        x, y, torch.ones(n_x, 1).to(x.device)
+        x, y, torch.ones(n_x, 1, dtype=x.dtype).to(x.device)
     )[:, 0]
     return output
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# TorchScript kernels of the primitives in sub_functional.py.
+# Branches are selected by torch.where instead of computing-and-masking,
+# polynomials are evaluated by Horner's rule, so that the fuser can compile
+# each primitive into a single element-wise kernel.
+
+import torch
+
+
+# TorchScript can not close over python globals, so the constants are inlined
+# as literals:
+#   0.6931471805599453 = ln(2)
+#   0.9189385332046727 = ln(√(2π))
+#   0.2316418882663604 = p / √2, with the coefficients p, a1 ... a5 of
+#       Abramowitz and Stegun, 7.1.26
+#   1e-30 = infinitesimal in utils.py
+
+
+@torch.jit.script
+def softminus(x):
+    """
+    log(1 - exp(x)) (x < 0), taking log(-expm1(x)) near 0 and
+    log1p(-exp(x)) towards -∞
+    """
+    return torch.where(
+        x > -0.6931471805599453,
+        torch.log(-torch.expm1(x)),
+        torch.log1p(-torch.exp(x)),
+    )
+
+
+@torch.jit.script
+def ln_pdf(x):
+    return x * x * -0.5 - 0.9189385332046727
+
+
+@torch.jit.script
+def ln_cdf(x, bound: float):
+    """
+    ln(Ø(x)) by the method 2 of ln_cdf_cls, clamping the exponent within
+    ±bound, infinite_of(x.dtype) in utils.py
+    """
+    t = torch.reciprocal(x.abs() * 0.2316418882663604 + 1)
+    poly = t * (t * (t * (t * (t * 1.061405429 - 1.453152027)
+                          + 1.421413741) - 0.284496736) + 0.254829592)
+    ln_inside = torch.clamp(
+        x * x * -0.5 + torch.log(poly) - 0.6931471805599453, -bound, bound)
+    return torch.where(x < 0, ln_inside, softminus(ln_inside))
+
+
+@torch.jit.script
+def ln_cdf_grad(x, ln_cdf_x, grad_output):
+    return torch.exp(ln_pdf(x) - ln_cdf_x) * grad_output
+
+
+@torch.jit.script
+def logit_ln(x, clamped):
+    return x - softminus(x) + torch.where(
+        clamped, x + 1e-30, torch.zeros_like(x))
+
+
+@torch.jit.script
+def logit_ln_grad(x, clamped, grad_output):
+    """
+    1 + 1 / (exp(-x) - 1) = -1 / expm1(x), evaluated in the latter form with
+    a single rounding, as the sum loses the last digits where the gradient
+    grows like -1/x
+    """
+    grad_x = -grad_output * torch.reciprocal(torch.expm1(x))
+    return torch.where(clamped, torch.ones_like(grad_x), grad_x)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# A lookup table of ln(Pr(X ∩ Y)) over (norm, norm, angle)
+
+import os
+import math
+import itertools
+import torch
+
+from utility.common import make_parent_dir
+from .sub_functional import ln_pdf, ln_cdf
+from .utils import infinitesimal, infinite, pair_norms
+
+
+# the angles are sampled evenly in warp(theta), denser towards π, up to
+# MAX_ANGLE. Pairs beyond are calculated by the closed form.
+MAX_ANGLE = math.pi * (1 - 1e-4)
+MAX_WARP = MAX_ANGLE - math.log1p(-MAX_ANGLE / math.pi)
+# maximum relative error of a cell, on ln(Pr) and on its derivative on the
+# cosine, measured at its center. Pairs in the cells beyond are calculated
+# by the closed form.
+TABLE_TOLERANCE = (1e-2, 1e-1)
+
+
+def table_filename(cache_dir, max_norm, shape, n_nodes):
+    # v2: ln(Pr) + corner_term on the warped angles
+    return os.path.join(
+        cache_dir,
+        f'intersection_table_v2_{max_norm}_{shape[0]}x{shape[1]}_'
+        f'{n_nodes}.pth'
+    )
+
+
+def load_intersection_table(cache_dir, max_norm, shape, n_nodes,
+                            ln_intersection_fn, device):
+    """
+    Loading the table from the cache directory, building it with
+    ln_intersection_fn (of n_nodes quadrature nodes) if not found. The table
+    is written to a temporary file and then renamed, so that parallel trials
+    can safely share it.
+    """
+    filename = table_filename(cache_dir, max_norm, shape, n_nodes)
+    if not os.path.exists(filename):
+        table = build_intersection_table(max_norm, shape, ln_intersection_fn)
+        make_parent_dir(filename)
+        temp_filename = f'{filename}.{os.getpid()}.tmp'
+        torch.save(table, temp_filename)
+        os.replace(temp_filename, filename)
+    table = torch.load(filename, map_location=device)
+    return table
+
+
+def build_intersection_table(max_norm, shape, ln_intersection_fn):
+    """
+    Output:
+        table: dict, with
+            'max_norm': the norms are sampled evenly in [0, max_norm]
+            'values': Tensor, shape = (4, n_norm, n_norm, n_angle)
+                ln(Pr) + corner_term and its partial derivatives on x, y
+                and the angle, the angles being sampled evenly in
+                warp(theta) on [0, MAX_ANGLE]
+            'exact': Tensor of bool, shape = (n_norm - 1, n_norm - 1,
+                n_angle - 1), the cells beyond TABLE_TOLERANCE
+            'error': the maximum relative errors on ln(Pr) and on its
+                derivative on the cosine over the other cells, and the
+                fraction of the exact cells
+
+    The angle is used instead of the cosine, because the derivative on
+    the cosine goes to infinity as sin(theta) goes to 0.
+    """
+    n_norm, n_angle = shape
+    norms = torch.linspace(0, max_norm, n_norm).double()
+    angles = unwarp(torch.linspace(0, MAX_WARP, n_angle).double())
+
+    values = []
+    with torch.no_grad():
+        for angle in angles:
+            cos = angle.cos().repeat(n_norm, n_norm)
+            ln_Pr = ln_intersection_fn(norms, norms, cos)
+            values.append(torch.stack(
+                (ln_Pr,) + ln_partials(norms, norms, cos, ln_Pr)
+            ) + torch.stack(corner_term(norms, norms, cos)))
+
+    table = {
+        'max_norm': max_norm,
+        'values': torch.stack(values, -1).float(),
+    }
+    table['exact'], table['error'] = interpolation_error(
+        table, ln_intersection_fn)
+    return table
+
+
+def interpolation_error(table, ln_intersection_fn):
+    """
+    Measuring the interpolation error of each cell at its center against
+    ln_intersection_fn.
+
+    Output:
+        the cells beyond TABLE_TOLERANCE, and the maximum errors over the
+        others (see build_intersection_table)
+    """
+    _, n_norm, _, n_angle = table['values'].shape
+    max_norm = table['max_norm']
+    norms = torch.linspace(0, max_norm, n_norm).double()
+    norms = (norms[1:] + norms[:-1]) / 2
+    u = torch.linspace(0, MAX_WARP, n_angle).double()
+    angles = unwarp((u[1:] + u[:-1]) / 2)
+    no_exact = torch.zeros(n_norm - 1, n_norm - 1, n_angle - 1,
+                           dtype=torch.bool)
+
+    exact, value_error, cos_error = [], 0, 0
+    with torch.no_grad():
+        for angle in angles:
+            cos = angle.cos().repeat(n_norm - 1, n_norm - 1)
+            sin = angle.sin()
+            ln_Pr = ln_intersection_fn(norms, norms, cos)
+            grad_cos = - ln_partials(norms, norms, cos, ln_Pr)[2] / sin
+            output = lookup(
+                table['values'], no_exact, max_norm, norms, norms, cos)[0]
+
+            value = (output[0] - ln_Pr).abs() / ln_Pr.abs().clamp(min=1)
+            on_cos = (- output[3] / sin - grad_cos).abs() / \
+                grad_cos.abs().clamp(min=1)
+            beyond = (value > TABLE_TOLERANCE[0]) | \
+                (on_cos > TABLE_TOLERANCE[1])
+            exact.append(beyond)
+            if not beyond.all():
+                value_error = max(value_error, value[~beyond].max().item())
+                cos_error = max(cos_error, on_cos[~beyond].max().item())
+
+    exact = torch.stack(exact, -1)
+    error = {
+        'value': value_error,
+        'cos': cos_error,
+        'exact': exact.double().mean().item(),
+    }
+    return exact, error
+
+
+def lookup(values, exact, max_norm, x, y, cos):
+    """
+    Interpolating ln(Pr) and its partial derivatives from the table.
+
+    Output:
+        Tensor, shape = (4,) + cos.shape
+        the pairs to be calculated by the closed form instead: those beyond
+        max_norm or MAX_ANGLE, or in an exact cell
+    """
+    _, n_norm, _, n_angle = values.shape
+    x, y = pair_norms(x, y, cos)
+    angle = cos.clamp(-1, 1).acos()
+    coords = (x / max_norm * (n_norm - 1),
+              y / max_norm * (n_norm - 1),
+              warp(angle.clamp(max=MAX_ANGLE)) / MAX_WARP * (n_angle - 1))
+    output = interpolate(values.to(cos.dtype), coords) - \
+        torch.stack(corner_term(x, y, cos))
+
+    cells = [coord.floor().long().clamp(0, n - 2)
+             for coord, n in zip(coords, (n_norm, n_norm, n_angle))]
+    outside = (x > max_norm) | (y > max_norm) | (angle > MAX_ANGLE)
+    return output, outside | exact[cells[0], cells[1], cells[2]]
+
+
+def warp(theta):
+    return theta - torch.log1p(-theta / math.pi)
+
+
+def unwarp(u, n_iteration=60):
+    """
+    The inverse of warp, by bisection on [0, π]
+    """
+    low = torch.zeros_like(u)
+    high = torch.full_like(u, math.pi)
+    for _ in range(n_iteration):
+        middle = (low + high) / 2
+        over = warp(middle) > u
+        high = torch.where(over, middle, high)
+        low = torch.where(over, low, middle)
+    return (low + high) / 2
+
+
+def corner_term(x, y, cos):
+    """
+    For cos < 0, ln(Pr) falls as the exponent at the corner (x, y)
+        -(x^2 - 2xy·cos + y^2) / (2sin^2)
+    which goes to infinity as theta goes to π. With c = min(cos, 0), the
+    term taken out of the table is
+        q = [(x^2 - 2xy·c + y^2) / (1 - c^2) - (x^2 + y^2)] / 2 + xy·c
+    leaving no jump in the value or the slope of the table at cos = 0.
+
+    Output:
+        q and its partial derivatives on x, y and the angle
+    """
+    x, y = pair_norms(x, y, cos)
+    c = cos.clamp(max=0)
+    sin_2 = 1 - c.pow(2)
+    q = (c.pow(2) * (x.pow(2) + y.pow(2)) - 2 * c * x * y) / (2 * sin_2) + \
+        c * x * y
+    grad_x = (c.pow(2) * x - c * y) / sin_2 + c * y
+    grad_y = (c.pow(2) * y - c * x) / sin_2 + c * x
+    grad_cos = (c * (x.pow(2) + y.pow(2)) - (1 + c.pow(2)) * x * y) / \
+        sin_2.pow(2) + x * y
+    grad_cos = torch.where(cos < 0, grad_cos, torch.zeros_like(grad_cos))
+    # d(cos) / d(theta) = -sin(theta)
+    grad_angle = - (1 - cos.pow(2)).clamp(0, 1).sqrt() * grad_cos
+    return q, grad_x, grad_y, grad_angle
+
+
+def ln_partials(x, y, cos, ln_Pr):
+    """
+    The partial derivatives of ln(Pr) on x, y and the angle,
+    calculated in double precision.
+
+    d(ln(Pr)) / d(theta) = -sin(theta) · d(ln(Pr)) / d(cos), where
+    (x^2 - 2xy·cos + y^2) / sin^2 = (x - y)^2 / sin^2 + 2xy / (1 + cos)
+    keeps it finite at sin(theta) = 0
+    """
+    dtype = cos.dtype
+    x, y = pair_norms(x.double(), y.double(), cos)
+    cos = cos.double()
+    ln_Pr = ln_Pr.double()
+    sin = (1 - cos.pow(2)).clamp(0, 1).sqrt()
+    csc = (1 / sin).clamp(0, infinite)
+
+    grad_x = - (ln_cdf((x * cos - y) * csc, True, True) +
+                ln_pdf(x) - ln_Pr).exp()
+    grad_y = - (ln_cdf((y * cos - x) * csc, True, True) +
+                ln_pdf(y) - ln_Pr).exp()
+    grad_angle = - (- (x - y).pow(2) * csc.pow(2) / 2
+                    - x * y / (1 + cos).clamp(infinitesimal, 2)
+                    - math.log(2 * math.pi) - ln_Pr).exp()
+
+    return grad_x.to(dtype), grad_y.to(dtype), grad_angle.to(dtype)
+
+
+def interpolate(values, coords):
+    """
+    Trilinear interpolation, by gathering from the 8 surrounding corners.
+
+    Input:
+        values: Tensor, shape = (k, n_0, n_1, n_2)
+        coords: 3 Tensors of the same shape, continuous indexes along the
+            3 grid dimensions
+
+    Output:
+        Tensor, shape = (k,) + coords[0].shape
+    """
+    shape = values.shape[1:]
+    flat = values.reshape(values.shape[0], -1)
+    lower, frac = [], []
+    for coord, n in zip(coords, shape):
+        floor = coord.floor().clamp(0, n - 2)
+        lower.append(floor.long())
+        frac.append(coord - floor)
+
+    output = 0
+    for corner in itertools.product((0, 1), repeat=3):
+        index = 0
+        weight = 1
+        for floor, fraction, n, bit in zip(lower, frac, shape, corner):
+            index = index * n + floor + bit
+            weight = weight * (fraction if bit else 1 - fraction)
+        output = output + flat[:, index] * weight
+
+    return output
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# A guard on the numerical validity of the half-Gaussian primitives
+
+from collections import deque
+import torch
+
+from utility.common import valid_part, assert_valid_value, make_parent_dir
+
+
+class NumericsGuard:
+    """
+    Checking the outputs of the primitives for nan / inf values.
+
+    Modes:
+        'sync': checking on every call, which is the original behaviour
+        'off': no checking at all
+        'sampled': checking on every `every`-th call of each primitive
+        'deferred': keeping the invalid flags on device, and checking them
+            all at once in `flush()`, e.g. once per training step. Only the
+            flags and snapshots of `snapshot_size` elements of each value and
+            input are kept meanwhile, and the flags are flushed by `check()`
+            itself once `max_pending` of them pile up.
+
+    On a violation, the values and the inputs of the primitive (or their
+    snapshots, in the deferred mode) are recorded to a ring buffer of the
+    latest `buffer_size` violations, which can be dumped by `dump()` for
+    post-mortem.
+    """
+
+    modes = ('sync', 'off', 'sampled', 'deferred')
+
+    def __init__(self, mode='sync', every=100, buffer_size=16,
+                 snapshot_size=64, max_pending=1024):
+        self.configure(mode, every, buffer_size, snapshot_size, max_pending)
+
+    def configure(self, mode, every=100, buffer_size=16,
+                  snapshot_size=64, max_pending=1024):
+        assert mode in self.modes, f'unsupported guard mode: {mode}'
+        self.mode = mode
+        self.every = every
+        self.snapshot_size = snapshot_size
+        self.max_pending = max_pending
+        self.violations = deque(maxlen=buffer_size)
+        self.counts = {}
+        self.pending = []
+        self.n_step = 0
+
+    def check(self, name, *values, assert_finite=False, inputs=()):
+        if self.mode == 'off':
+            return
+        elif self.mode == 'sampled':
+            count = self.counts.get(name, 0)
+            self.counts[name] = count + 1
+            if count % self.every != 0:
+                return
+        elif self.mode == 'deferred':
+            invalids = [~valid_part(value, assert_finite) for value in values]
+            invalid = torch.stack([one.any() for one in invalids]).any()
+            self.pending.append((
+                name, invalid,
+                tuple(self.snapshot(value, one)
+                      for value, one in zip(values, invalids)),
+                tuple(self.snapshot(one) for one in inputs),
+            ))
+            if len(self.pending) >= self.max_pending:
+                self.flush(step=False)
+            return
+
+        for value in values:
+            if not valid_part(value, assert_finite).all():
+                self.record(name, values, inputs)
+                assert_valid_value(*values, assert_finite=assert_finite)
+
+    def snapshot(self, tensor, invalid=None):
+        """
+        A copy of `snapshot_size` elements of the tensor on its device,
+        around its first invalid element if the invalid mask is given
+        """
+        if not isinstance(tensor, torch.Tensor):
+            return tensor
+        flat = tensor.detach().reshape(-1)
+        size = self.snapshot_size
+        if flat.numel() <= size:
+            return flat.clone()
+        if invalid is None:
+            return flat[:size].clone()
+        first = invalid.reshape(-1).float().argmax()
+        start = (first - size // 2).clamp(0, flat.numel() - size)
+        index = start + torch.arange(size, device=flat.device)
+        return flat[index]
+
+    def flush(self, step=True):
+        """
+        Checking the deferred flags with a single synchronization
+        """
+        if step:
+            self.n_step += 1
+        if len(self.pending) == 0:
+            return
+        pending = self.pending
+        self.pending = []
+        invalid = torch.stack([
+            flag.to(pending[0][1].device) for _, flag, _, _ in pending
+        ]).cpu()
+        if not invalid.any():
+            return
+        for (name, _, values, inputs), flag in zip(pending, invalid):
+            if flag:
+                self.record(name, values, inputs)
+        names = [name for (name, _, _, _), flag in zip(pending, invalid)
+                 if flag]
+        raise Exception(f'invalid value in {", ".join(names)}')
+
+    def record(self, name, values, inputs):
+        def to_cpu(tensors):
+            return tuple(
+                tensor.detach().cpu().clone()
+                if isinstance(tensor, torch.Tensor) else tensor
+                for tensor in tensors
+            )
+
+        self.violations.append({
+            'name': name,
+            'step': self.n_step,
+            'values': to_cpu(values),
+            'inputs': to_cpu(inputs),
+        })
+
+    def dump(self, filename):
+        make_parent_dir(filename)
+        torch.save(list(self.violations), filename)
+
+
+guard = NumericsGuard()
@@ -18,6 +18,13 @@ from utility.common import min_fn, log, detach
 
 
 INF = 100
+# heads of the metaconcept net
+METACONCEPT_INDEX = {
+    'synonym': 0, 'hypernym': 2, 'samekind': 3, 'meronym': 4,
+}
+# maximum number of (concept pair, sample point) elements in one
+# metaconcept evaluation
+MAX_DENSE_ELEMENTS = 2 ** 24
 
 
 class ProgramExecutor(nn.Module):
@@ -29,6 +36,8 @@ class ProgramExecutor(nn.Module):
         self.args = args
         self.tools = tools
         self.device = device
+        # compiled plans of the batched executor
+        self.plans = {}
 
     def build(self):
         self.exist_offset = nn.Parameter(torch.tensor(0.))
@@ -85,6 +94,212 @@ class ProgramExecutor(nn.Module):
             loss = loss * self.args.conceptual_weight
         return loss, output, debug
 
+    def forward_batch(
+        self,
+        programs, answers, question_cats,
+        objects, logits,
+        embedding,
+    ):
+        """
+        Executing a batch of programs. Programs with the same sequence of
+        operations are grouped, and each operation runs as a single tensor
+        operation over the group, with object sets padded and masked.
+        Metaconcept questions (a concept judged against another) of all
+        kinds form a single group, evaluated densely on distinct concepts.
+        The outputs are the same as calling forward on each question; a
+        group failing to execute falls back to that, questions that still
+        fail getting an uninformative answer.
+
+        Output:
+            a list of (loss, output, debug) for each question
+        """
+        groups = {}
+        for i, program in enumerate(programs):
+            signature = tuple(op['operation'] for op in program)
+            if is_metaconcept(signature):
+                signature = 'metaconcept'
+            groups.setdefault(signature, []).append(i)
+
+        outputs = [None] * len(programs)
+        for signature, indexes in groups.items():
+            try:
+                if signature == 'metaconcept':
+                    results = self.execute_metaconcepts(
+                        [programs[i] for i in indexes], embedding)
+                else:
+                    results = self.execute_group(
+                        signature,
+                        [programs[i] for i in indexes],
+                        [objects[i] for i in indexes],
+                        [logits[i] for i in indexes],
+                        embedding,
+                    )
+            except Exception:
+                results = None
+
+            for k, i in enumerate(indexes):
+                # as with the serial calls, a question failing either in
+                # execution or in analysis (e.g. an unknown answer) gets an
+                # uninformative answer, without failing the others
+                try:
+                    if results is not None:
+                        loss, output, debug = self.analyze(
+                            (results[0], results[1][k]), answers[i])
+                        if question_cats[i] == 'conceptual':
+                            loss = loss * self.args.conceptual_weight
+                        outputs[i] = (loss, output, debug)
+                    else:
+                        outputs[i] = self(
+                            programs[i], answers[i], question_cats[i],
+                            objects[i], logits[i], embedding,
+                        )
+                except Exception:
+                    outputs[i] = (0, {'yes': 0.5, 'no': 0.5}, {})
+
+        return outputs
+
+    def execute_group(self, signature, programs, objects, logits, embedding):
+        """
+        Running programs sharing the operation sequence `signature`, by its
+        compiled plan. Results are batched along the first dimension.
+        """
+        plan = self.compile(signature)
+        state = {
+            'programs': programs,
+            'objects': objects,
+            'logits': logits,
+            'embedding': embedding,
+        }
+        if 'select_object' in signature:
+            state['objects'], state['mask'] = pad_objects(objects)
+
+        result = None
+        for j, handler in plan:
+            result = handler(result, j, state)
+        return result
+
+    def execute_metaconcepts(self, programs, embedding):
+        """
+        Running programs of the form select_concept(A), <relation>(B).
+        The distinct (A, B) pairs are evaluated row by row with
+        determine_relation_pairs, in chunks of MAX_DENSE_ELEMENTS over the
+        sample size of the intersection, so that the work is linear in the
+        pairs. The judgements are gathered back by (A, B, head).
+        """
+        firsts, seconds, heads = [], [], []
+        for program in programs:
+            steps = [op for op in program if op['operation'] != '<END>']
+            firsts.append(self.tools.concepts[steps[0]['argument']])
+            seconds.append(self.tools.concepts[steps[1]['argument']])
+            heads.append(METACONCEPT_INDEX[steps[1]['operation']])
+
+        pairs = sorted(set(zip(firsts, seconds)))
+        pair_index = {pair: k for k, pair in enumerate(pairs)}
+
+        detach_concept = self.args.detach_in_rel
+        n_chunk = max(1, MAX_DENSE_ELEMENTS // self.args.sample_size)
+        judgement = []
+        for k in range(0, len(pairs), n_chunk):
+            chunk_firsts, chunk_seconds = zip(*pairs[k: k + n_chunk])
+            concepts1 = embedding.concept_embedding(
+                torch.LongTensor(chunk_firsts).to(self.device))
+            concepts2 = embedding.concept_embedding(
+                torch.LongTensor(chunk_seconds).to(self.device))
+            judgement.append(embedding.determine_relation_pairs(
+                concepts1, concepts2,
+                detach=(detach_concept, detach_concept),
+            ))
+        judgement = torch.cat(judgement)
+
+        index = torch.LongTensor([
+            pair_index[pair] for pair in zip(firsts, seconds)
+        ]).to(self.device)
+        heads = torch.LongTensor(heads).to(self.device)
+        return 'boolean', judgement[index, heads]
+
+    def compile(self, signature):
+        """
+        Resolving the operation handlers of an operation sequence once,
+        the plans being cached by the sequence across batches and epochs.
+        '<END>' steps are dropped from the plan.
+        """
+        if signature not in self.plans:
+            handlers = {
+                'select_object': self.group_select_object,
+                'select_concept': self.group_select_concept,
+                'unique_object': self.group_unique_object,
+                'filter': self.group_filter,
+                'exist': self.group_exist,
+                'synonym': self.group_relation,
+                'hypernym': self.group_relation,
+                'samekind': self.group_relation,
+                'meronym': self.group_relation,
+                'isinstanceof': self.group_isinstanceof,
+            }
+            plan = []
+            for j, operation in enumerate(signature):
+                if operation == '<END>':
+                    continue
+                elif operation == 'query':
+                    raise NotImplementedError(
+                        'Querying module not implemented')
+                elif operation not in handlers:
+                    raise Exception(
+                        'unsupported opeartion: {}'.format(operation))
+                plan.append((j, handlers[operation]))
+            self.plans[signature] = plan
+        return self.plans[signature]
+
+    def concept_indexes(self, state, j):
+        """
+        The concept indexes of the j-th arguments, as a LongTensor on the
+        device
+        """
+        return torch.LongTensor([
+            self.tools.concepts[program[j]['argument']]
+            for program in state['programs']
+        ]).to(self.device)
+
+    # the following are batched operation modules
+
+    def group_select_object(self, result, j, state):
+        return 'object_logits', \
+            torch.ones(state['mask'].shape).to(self.device) * INF
+
+    def group_select_concept(self, result, j, state):
+        return 'concept_embedding', state['embedding'].concept_embedding(
+            self.concept_indexes(state, j))
+
+    def group_unique_object(self, result, j, state):
+        weights = F.softmax(
+            result[1].masked_fill(~state['mask'], -float('inf')), dim=1)
+        return 'object_embedding', \
+            (weights[:, :, None] * state['objects']).sum(1)
+
+    def group_filter(self, result, j, state):
+        step_logits = pad_logits(
+            [one[j] for one in state['logits']], state['mask'])
+        return self.filter_fn(result, step_logits)
+
+    def group_exist(self, result, j, state):
+        return self.exist_fn((
+            result[0],
+            result[1].masked_fill(~state['mask'], -float('inf'))
+        ), dim=1)
+
+    def group_relation(self, result, j, state):
+        operation = state['programs'][0][j]['operation']
+        another_concepts = state['embedding'].concept_embedding(
+            self.concept_indexes(state, j))
+        return 'boolean', torch.stack([
+            self.judge_concepts(
+                one, another, state['embedding'], operation)
+            for one, another in zip(result[1], another_concepts)
+        ])
+
+    def group_isinstanceof(self, result, j, state):
+        return self.isinstanceof_fn(result, state['embedding'])
+
     # the following are operation modules
 
     def select_object_fn(self, n, INF):
@@ -95,7 +310,7 @@ class ProgramExecutor(nn.Module):
             embedding.get_embedding('concept', argument)
 
     def unique_object_fn(self, result, objects):
-        weighted_sum = (F.softmax(result[1], dim=0)[None] *
+        weighted_sum = (F.softmax(result[1], dim=0)[:, None] *
                         objects).sum(0)
         return 'object_embedding', weighted_sum
 
@@ -108,11 +323,15 @@ class ProgramExecutor(nn.Module):
         filtered_logits = min_fn(results[1], logits)
         return 'object_logits', filtered_logits
 
-    def exist_fn(self, result):
+    def exist_fn(self, result, dim=None):
+        if dim is None:
+            max_logit = result[1].max()
+        else:
+            max_logit = result[1].max(dim)[0]
         if self.args.not_build_reasoning:
-            output = result[1].max()
+            output = max_logit
         else:
-            output = (result[1].max() + self.exist_offset) * self.exist_scale
+            output = (max_logit + self.exist_offset) * self.exist_scale
         return ('boolean', output)
 
     def isinstanceof_fn(self, result, embedding):
@@ -121,7 +340,7 @@ class ProgramExecutor(nn.Module):
         result = embedding.determine_relation(
             result[1], attributes,
             detach=(detach_concept, False),
-        )[:, 1]
+        )[..., 1]
         result = (
             'attribute_logits',
             result,
@@ -129,21 +348,22 @@ class ProgramExecutor(nn.Module):
         return result
 
     def judge_relation(self, result, argument, embedding, operation):
-        metaconcept_index = {
-            'synonym': 0, 'hypernym': 2, 'samekind': 3, 'meronym': 4,
-        }[operation]
         another_concept = embedding.get_embedding('concept', argument)
+        result = (
+            'boolean',
+            self.judge_concepts(
+                result[1], another_concept, embedding, operation)
+        )
+        return result
 
+    def judge_concepts(self, concept, another_concept, embedding, operation):
+        metaconcept_index = METACONCEPT_INDEX[operation]
         detach_concept = self.args.detach_in_rel
         judgement = embedding.determine_relation(
-            result[1], another_concept,
+            concept, another_concept,
             detach=(detach_concept, detach_concept),
         )
-        result = (
-            'boolean',
-            judgement[metaconcept_index]
-        )
-        return result
+        return judgement[metaconcept_index]
 
     # analyzing outputs
 
@@ -184,6 +404,52 @@ class ProgramExecutor(nn.Module):
         pass
 
 
+def is_metaconcept(signature):
+    operations = [operation for operation in signature
+                  if operation != '<END>']
+    return len(operations) == 2 and \
+        operations[0] == 'select_concept' and \
+        operations[1] in METACONCEPT_INDEX
+
+
+def pad_objects(objects):
+    """
+    Padding a list of (n_i, dim) object tensors into (n, max(n_i), dim),
+    with a mask of shape (n, max(n_i)) on the valid objects
+    """
+    lengths = [one.shape[0] for one in objects]
+    # an empty object set fails in the serial executor, as it should here
+    assert min(lengths) > 0, 'empty object set'
+    padded = objects[0].new_zeros(
+        (len(objects), max(lengths)) + objects[0].shape[1:])
+    mask = torch.zeros(len(objects), max(lengths),
+                       dtype=torch.bool, device=objects[0].device)
+    for i, one in enumerate(objects):
+        padded[i, :lengths[i]] = one
+        mask[i, :lengths[i]] = True
+    return padded, mask
+
+
+def pad_stack(tensors):
+    """
+    Stacking 2-d tensors of different shapes, padding them with zeros
+    """
+    shape = (len(tensors),
+             max(one.shape[0] for one in tensors),
+             max(one.shape[1] for one in tensors))
+    padded = tensors[0].new_zeros(shape)
+    for i, one in enumerate(tensors):
+        padded[i, :one.shape[0], :one.shape[1]] = one
+    return padded
+
+
+def pad_logits(logits, mask):
+    padded = logits[0].new_zeros(mask.shape)
+    for i, one in enumerate(logits):
+        padded[i, :one.shape[0]] = one
+    return padded
+
+
 class Classification(nn.Module):
     def __init__(self, args, tools, device):
         super().__init__()
@@ -203,5 +469,30 @@ class Classification(nn.Module):
 
         return binary_loss, output, {}
 
+    def forward_batch(self, logits, answers):
+        """
+        The same as forward on each question, with the (objects, concepts)
+        logits of all questions padded into one tensor, so that the sigmoid
+        and the binary cross-entropy run once for the batch
+
+        Output:
+            a list of (binary_loss, output, debug) for each question
+        """
+        classify_logits = [torch.stack(one).transpose(1, 0) for one in logits]
+        padded_logits = pad_stack(classify_logits)
+        padded_targets = pad_stack([
+            answer.to(self.device) for answer in answers])
+        binary_loss = F.binary_cross_entropy_with_logits(
+            padded_logits, padded_targets, reduction='none'
+        )
+        output = detach(torch.sigmoid(padded_logits))
+
+        results = []
+        for k, one in enumerate(classify_logits):
+            n, m = one.shape
+            results.append(
+                (binary_loss[k, :n, :m], output[k, :n, :m], {}))
+        return results
+
     def init(self):
         pass
@@ -17,9 +17,15 @@ import torch.autograd as autograd
 from torch.distributions import Normal
 import numpy as np
 
-from utility.common import assert_valid_value
 from .utils import \
-    infinitesimal, infinite, clamp_infinite
+    infinitesimal, infinite, infinite_of, clamp_infinite
+from . import fused
+from .numerics import guard
+
+
+# whether to run the TorchScript kernels in fused.py, the original
+# implementations are kept as the reference for them
+FUSED = True
 
 
 class LogitLn_cls(autograd.Function):
@@ -54,12 +60,15 @@ class LogitLn_cls(autograd.Function):
         x = x.clamp(-infinite, -infinitesimal)
         ctx.save_for_backward(x, clamped, torch.BoolTensor([slack]))
 
-        a = x
-        b = stable_softminus(x)
-        logit = a - b + (x + infinitesimal) * clamped.float()
+        if FUSED:
+            logit = fused.logit_ln(x, clamped)
+        else:
+            a = x
+            b = stable_softminus(x)
+            logit = a - b + (x + infinitesimal) * clamped.float()
 
         if not slack:
-            assert_valid_value(logit)
+            guard.check('logit_ln.forward', logit, inputs=(x,))
         return logit
 
     @staticmethod
@@ -76,19 +85,23 @@ class LogitLn_cls(autograd.Function):
 
         x, clamped, slack = ctx.saved_tensors
 
-        a1 = (-x).exp() - 1
-        a2 = -x
-        switch = x.exp() == 1
-        a1[switch] = 0
-        a2[~switch] = 0
-        a = a1 + a2
+        if FUSED:
+            grad_x = fused.logit_ln_grad(x, clamped, grad_output)
+        else:
+            a1 = (-x).exp() - 1
+            a2 = -x
+            switch = x.exp() == 1
+            a1[switch] = 0
+            a2[~switch] = 0
+            a = a1 + a2
 
-        grad_x = grad_output * (1 + 1 / a)
-        # clip out gradient when x is super high
-        grad_x[clamped] = 1
+            grad_x = grad_output * (1 + 1 / a)
+            # clip out gradient when x is super high
+            grad_x[clamped] = 1
 
         if not slack:
-            assert_valid_value(grad_x)
+            guard.check('logit_ln.backward', grad_x,
+                        inputs=(x, grad_output))
         return grad_x, None
 
 
@@ -110,9 +123,10 @@ class ln_cdf_cls(autograd.Function):
             https://github.com/scipy/scipy/blob/master/scipy/special/cephes/ndtr.c
         Method 2 follows from "Abramowitz and Stegun", 7.1.28
         Method 3 follows from "global Padé approximations"
+        Method 4 is the fused kernel of method 2
         """
 
-        method_chosen = 2
+        method_chosen = 4 if FUSED else 2
 
         if method_chosen == 1:
             # Method 1
@@ -189,18 +203,25 @@ class ln_cdf_cls(autograd.Function):
 
             ln = ln1 + ln2 + ln3 + ln4
 
+        elif method_chosen == 4:
+            ln = fused.ln_cdf(x, infinite_of(x.dtype))
+
         if not slack:
-            assert_valid_value(ln)
+            guard.check('ln_cdf.forward', ln, inputs=(x,))
         ctx.save_for_backward(x, ln, torch.BoolTensor([slack]))
         return ln
 
     @staticmethod
     def backward(ctx, grad_output):
         x, ln_cdf_x, slack = ctx.saved_tensors
-        ln_pdf_x = ln_pdf(x)
-        grad_x = (ln_pdf_x - ln_cdf_x).exp() * grad_output
+        if FUSED:
+            grad_x = fused.ln_cdf_grad(x, ln_cdf_x, grad_output)
+        else:
+            ln_pdf_x = ln_pdf(x)
+            grad_x = (ln_pdf_x - ln_cdf_x).exp() * grad_output
         if not slack:
-            assert_valid_value(grad_x, assert_finite=True)
+            guard.check('ln_cdf.backward', grad_x, assert_finite=True,
+                        inputs=(x, grad_output))
         return grad_x, None
 
 
@@ -217,11 +238,14 @@ class ln_pdf_cls(autograd.Function):
 
     @staticmethod
     def forward(ctx, x, slack=False):
-        ln = - x.pow(2) / 2 - math.log(2 * math.pi) / 2
+        if FUSED:
+            ln = fused.ln_pdf(x)
+        else:
+            ln = - x.pow(2) / 2 - math.log(2 * math.pi) / 2
 
         ctx.save_for_backward(x, torch.BoolTensor([slack]))
         if not slack:
-            assert_valid_value(ln)
+            guard.check('ln_pdf.forward', ln, inputs=(x,))
         return ln
 
     @staticmethod
@@ -230,7 +254,8 @@ class ln_pdf_cls(autograd.Function):
 
         grad_x = -x * grad_output
         if not slack:
-            assert_valid_value(grad_x)
+            guard.check('ln_pdf.backward', grad_x,
+                        inputs=(x, grad_output))
         return grad_x, None
 
 
@@ -249,10 +274,59 @@ def cdf(x, recursive=True):
     return output
 
 
+def gauss_legendre(n_nodes, device):
+    """
+    Gauss-Legendre nodes on [-1, 1] and the log of their weights,
+    as double-precision tensors
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(n_nodes)
+    nodes = torch.from_numpy(nodes).to(device)
+    ln_weights = torch.from_numpy(np.log(weights)).to(device)
+    return nodes, ln_weights
+
+
+def ln_owen_tail(h, a, nodes, ln_weights, ln_range=25):
+    """
+    Calculating ln(T(h, +∞) - T(h, a)) (h > 0), where T is Owen's T function
+
+    T(h, +∞) - T(h, a) = 1/2π ∫[atan(a), π/2](exp(-h^2 / 2cos(t)^2))
+    The range [atan(a), π/2] is split at 0 when a < 0, and cut where the
+    integrand falls below exp(-ln_range) of its peak. Each part is integrated
+    by Gauss-Legendre on s = ln(π/2 - t), which keeps the integrand smooth for
+    both small and large h.
+    """
+    width = math.sqrt(2 * ln_range) / h
+    a_pos = a.clamp(min=0)
+    upper = ln_owen_segment(
+        h, a_pos, (a_pos.pow(2) + width.pow(2)).sqrt(), nodes, ln_weights)
+    lower = ln_owen_segment(
+        h, torch.zeros_like(a), torch.min((-a).clamp(min=0), width),
+        nodes, ln_weights)
+    return torch.stack([upper, lower]).logsumexp(0)
+
+
+def ln_owen_segment(h, t1, t2, nodes, ln_weights):
+    """
+    ln(1/2π ∫[atan(t1), atan(t2)](exp(-h^2 / 2cos(t)^2))), 0 <= t1 <= t2
+    """
+    ones = torch.ones_like(t1)
+    s_lo = torch.atan2(ones, t2).log()
+    s_hi = torch.atan2(ones, t1).log()
+    half = ((s_hi - s_lo) / 2)[..., None]
+    s = (s_hi + s_lo)[..., None] / 2 + half * nodes
+    ln_integrand = s - h[..., None].pow(2) / 2 / s.exp().sin().pow(2)
+    output = (ln_integrand + ln_weights).logsumexp(-1) + half[..., 0].log() \
+        - math.log(2 * math.pi)
+    return output
+
+
 def stable_softminus(x):
     """
     Calculating log(1 - exp(x)) (x < 0) in a numerically stable way
     """
+    if FUSED:
+        return fused.softminus(x)
+
     # negative normal range
     y1 = (1 - x.exp()).log()
     # negative zero
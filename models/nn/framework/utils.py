@@ -18,9 +18,53 @@ infinite = 1e30
 finite = 1e3
 
 
+def infinite_of(dtype):
+    """
+    `infinite`, or the largest finite value of dtype if it is smaller
+    """
+    return min(infinite, torch.finfo(dtype).max)
+
+
 def clamp_infinite(value):
-    return torch.clamp(value, -infinite, infinite)
+    bound = infinite_of(value.dtype)
+    return torch.clamp(value, -bound, bound)
 
 
 def clamp_finite(value):
     return torch.clamp(value, -finite, finite)
+
+
+def pair_norms(x, y, cos):
+    """
+    x and y laid out against cos, of shape (n_x, n_y). 1-d norms are the
+    rows and the columns of a cartesian call, while 2-d ones, e.g. of shape
+    (n, 1) for a call on n paired vectors, are broadcast as they are.
+    """
+    if x.dim() == 1:
+        x = x[:, None]
+    if y.dim() == 1:
+        y = y[None]
+    return x.expand_as(cos), y.expand_as(cos)
+
+
+def sum_pair_grads(grad_x, grad_y, x, y):
+    """
+    Summing the gradients on the pairs back to the layout of the norms x and
+    y (see pair_norms)
+    """
+    grad_x = grad_x.sum(1) if x.dim() == 1 else grad_x.sum_to_size(x.shape)
+    grad_y = grad_y.sum(0) if y.dim() == 1 else grad_y.sum_to_size(y.shape)
+    return grad_x, grad_y
+
+
+def equal_rows(x, y):
+    """
+    equal[i, j] = (x[i] == y[j]).all(), for 2-d tensors x and y.
+    Rows are grouped by torch.unique, so that no (n_x, n_y, dim) tensor
+    is built for comparison.
+    """
+    _, inverse = torch.unique(
+        torch.cat([x, y]).detach(), dim=0, return_inverse=True)
+    n_x = x.shape[0]
+    equal = inverse[:n_x, None] == inverse[None, n_x:]
+    return equal
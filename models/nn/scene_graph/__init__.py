@@ -9,7 +9,8 @@
 # Distributed under terms of the MIT license.
 
 __all__ = [
-    'ResNetSceneGraph'
+    'ResNetSceneGraph', 'build_trunk', 'ObjectCache'
 ]
 
-from .resnet import ResNetSceneGraph
+from .resnet import ResNetSceneGraph, build_trunk
+from .object_cache import ObjectCache
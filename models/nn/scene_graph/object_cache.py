@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# A cache of per-object scene-graph features
+
+import os
+import shutil
+import hashlib
+from collections import OrderedDict
+import torch
+
+
+class ObjectCache:
+    """
+    An LRU cache of the scene-graph outputs of images, keyed by image id and
+    the hash of the object boxes, valid for one version of the vision
+    parameters. Entries evicted from the memory are spilled to `spill_dir`
+    on disk, if given.
+    """
+
+    def __init__(self, capacity, spill_dir=None):
+        self.capacity = capacity
+        self.spill_dir = spill_dir
+        self.memory = OrderedDict()
+        self.spilled = set()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(image_id, boxes):
+        sha = hashlib.sha1(boxes.detach().cpu().numpy().tobytes())
+        return f'{image_id}_{sha.hexdigest()[:16]}'
+
+    def validate(self, version):
+        """
+        Dropping all entries computed by another version of parameters
+        """
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def clear(self):
+        self.memory.clear()
+        for key in self.spilled:
+            os.remove(self.spill_filename(key))
+        self.spilled.clear()
+
+    def spill_filename(self, key):
+        return os.path.join(self.spill_dir, f'{key}.pth')
+
+    def get(self, key, device):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            value = self.memory[key]
+        elif key in self.spilled:
+            value = torch.load(self.spill_filename(key), map_location=device)
+            os.remove(self.spill_filename(key))
+            self.spilled.remove(key)
+            self.put(key, value)
+        else:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.memory[key] = tuple(
+            None if one is None else one.detach() for one in value
+        )
+        while len(self.memory) > self.capacity:
+            old_key, old_value = self.memory.popitem(last=False)
+            if self.spill_dir is not None:
+                torch.save(tuple(
+                    None if one is None else one.cpu() for one in old_value
+                ), self.spill_filename(old_key))
+                self.spilled.add(old_key)
+
+    def close(self):
+        self.clear()
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def __len__(self):
+        return len(self.memory) + len(self.spilled)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# A pure-PyTorch Precise RoI Pooling, for devices without the CUDA extension
+
+import torch
+import torch.nn as nn
+import jactorch.nn as jacnn
+
+__all__ = ['PrRoIPool2D', 'prroi_pool2d']
+
+
+def hat_integral(t):
+    """
+    ∫[-∞, t](max(0, 1 - |s|))ds, the integral of the bilinear weight
+    """
+    t = t.clamp(-1, 1)
+    return torch.where(t < 0, (1 + t).pow(2) / 2, 1 - (1 - t).pow(2) / 2)
+
+
+def axis_weights(start, end, n_bins, size):
+    """
+    The integrals of the bilinear weights of each grid point over each bin
+
+    Input:
+        start, end: Tensor, shape = (n_rois,), the range of the rois
+        n_bins: num of bins along the axis
+        size: num of grid points along the axis
+
+    Output:
+        Tensor, shape = (n_rois, n_bins, size)
+    """
+    bin_size = (end - start) / n_bins
+    steps = torch.arange(n_bins + 1, dtype=start.dtype, device=start.device)
+    edges = start[:, None] + bin_size[:, None] * steps
+    grid = torch.arange(size, dtype=start.dtype, device=start.device)
+    integral = hat_integral(edges[:, :, None] - grid)
+    return integral[:, 1:] - integral[:, :-1]
+
+
+def prroi_pool2d(features, rois, pooled_height, pooled_width, spatial_scale):
+    """
+    Averaging the bilinearly-interpolated features over each bin exactly.
+    The interpolation is separable, so the integral over a bin is
+        Σ_ij ∫ hat(y - i) dy · features[i, j] · ∫ hat(x - j) dx
+    which is a pair of matrix products for all rois and bins at once.
+
+    Input:
+        features: Tensor, shape = (batch, channel, height, width)
+        rois: Tensor, shape = (n_rois, 5), (batch index, x1, y1, x2, y2)
+
+    Output:
+        Tensor, shape = (n_rois, channel, pooled_height, pooled_width)
+    """
+    rois = rois.to(features.dtype)
+    batch_ind = rois[:, 0].long()
+    x1, y1, x2, y2 = (rois[:, 1:] * spatial_scale).unbind(1)
+    x2 = torch.max(x1, x2)
+    y2 = torch.max(y1, y2)
+
+    weight_y = axis_weights(y1, y2, pooled_height, features.size(2))
+    weight_x = axis_weights(x1, x2, pooled_width, features.size(3))
+    pooled = torch.matmul(
+        torch.matmul(weight_y[:, None], features[batch_ind]),
+        weight_x[:, None].transpose(-1, -2)
+    )
+
+    # empty bins are pooled to zero
+    area = (x2 - x1) * (y2 - y1) / (pooled_height * pooled_width)
+    area = torch.where(area > 0, area, torch.ones_like(area))
+    return pooled / area[:, None, None, None]
+
+
+class PrRoIPool2D(nn.Module):
+    """
+    Precise RoI Pooling, running the jactorch CUDA extension on GPU, and the
+    pure-PyTorch implementation otherwise
+    """
+
+    def __init__(self, pooled_height, pooled_width, spatial_scale):
+        super().__init__()
+        self.pooled_height = int(pooled_height)
+        self.pooled_width = int(pooled_width)
+        self.spatial_scale = float(spatial_scale)
+        self.cuda_pool = jacnn.PrRoIPool2D(
+            pooled_height, pooled_width, spatial_scale)
+
+    def forward(self, features, rois):
+        if features.is_cuda:
+            return self.cuda_pool(features, rois)
+        return prroi_pool2d(features, rois, self.pooled_height,
+                            self.pooled_width, self.spatial_scale)
@@ -20,49 +20,113 @@
 # This file is part of NSCL-PyTorch.
 # Distributed under terms of the MIT license.
 
+import torch
 import torch.nn as nn
 import jactorch.nn as jacnn
 import jactorch.models.vision.resnet as resnet
 from .scene_graph import SceneGraph
 
 
+def build_trunk():
+    """
+    The resnet34 trunk (up to layer3) shared by the visual models
+    """
+    trunk = resnet.resnet34(
+        pretrained=True,
+        incl_gap=False,
+        num_classes=None
+    )
+    trunk.layer4 = jacnn.Identity()
+    return trunk
+
+
 class ResNetSceneGraph(nn.Module):
-    def __init__(self, device, relation=True, dropout_rate=0):
+    """
+    The trunk followed by the scene graph. `relation` and `relation_k` are
+    passed on to SceneGraph; they are library-level options, as none of the
+    models here reads the relation features (VCML_Model builds it with
+    relation=False), so no command-line argument exposes them.
+    """
+
+    def __init__(self, device, relation=True, dropout_rate=0, relation_k=0):
         super().__init__()
 
         self.device = device
-        self.resnet = resnet.resnet34(
-            pretrained=True,
-            incl_gap=False,
-            num_classes=None
-        )
-        self.resnet.layer4 = jacnn.Identity()
+        self.resnet = build_trunk()
         self.scene_graph = SceneGraph(256,
                                       [None, 512, 512],
                                       16,
-                                      relation=relation)
+                                      relation=relation,
+                                      relation_k=relation_k)
         self.dropout_rate = dropout_rate
         self.dropout = nn.Dropout(p=dropout_rate)
 
-    def forward(self, batch):
-        valid_indexes = [
-            i for i, length in enumerate(batch['object_length'])
-            if length > 0
-        ]
-        features = self.resnet(batch['image'].to(self.device))
-        dropout_features = self.dropout(features)
-        if len(valid_indexes) > 0:
+    def forward(self, batch, cache=None):
+        """
+        Only the images with objects go through the backbone, each unique
+        image once. batch['image_rows'] gives the row in batch['image'] of
+        each sample, so that questions on the same image share one image
+        (and image-free samples may be left out).
+        If batch['feature'] is given, the trunk outputs are read from it
+        instead, along with batch['feature_rows'].
+        Out of training, the scene graphs of images found in the ObjectCache
+        `cache` are not computed again.
+
+        Output:
+            features, dropout_features: of the images computed
+            output: the scene graph of each sample
+        """
+        batch_size = batch['batch_size']
+        key = 'feature' if 'feature' in batch else 'image'
+        image_rows = batch.get(f'{key}_rows', list(range(batch_size)))
+        object_length = batch['object_length']
+        lengths = object_length.tolist()
+        object_start = [0] + object_length.cumsum(0).tolist()[:-1]
+
+        def boxes(i):
+            return batch['objects'][
+                object_start[i]: object_start[i] + lengths[i]]
+
+        # the first sample of each unique image
+        leaders, leader_of_row = [], {}
+        for i in range(batch_size):
+            if lengths[i] > 0 and image_rows[i] not in leader_of_row:
+                leader_of_row[image_rows[i]] = len(leaders)
+                leaders.append(i)
+
+        graphs = [None] * len(leaders)
+        use_cache = cache is not None and not self.training and \
+            'image_id' in batch
+        if use_cache:
+            cache_keys = [cache.key(batch['image_id'][i], boxes(i))
+                          for i in leaders]
+            graphs = [cache.get(one, self.device) for one in cache_keys]
+        todo = [j for j, graph in enumerate(graphs) if graph is None]
+
+        if len(todo) > 0:
+            rows = [image_rows[leaders[j]] for j in todo]
+            if key == 'feature':
+                features = batch['feature'][rows].to(self.device).float()
+            else:
+                features = self.resnet(batch['image'][rows].to(self.device))
+            dropout_features = self.dropout(features)
+            objects = torch.cat([boxes(leaders[j]) for j in todo])
             output = self.scene_graph(
-                dropout_features[valid_indexes],
-                batch['objects'].to(self.device),
-                batch['object_length'][valid_indexes].to(self.device)
+                dropout_features,
+                objects.to(self.device),
+                object_length[[leaders[j] for j in todo]].to(self.device)
             )
+            for j, graph in zip(todo, output):
+                graphs[j] = graph
+                if use_cache:
+                    cache.put(cache_keys[j], graph)
         else:
-            output = []
+            features, dropout_features = None, None
+
         output = [
-            output[valid_indexes.index(i)]
-            if i in valid_indexes
+            graphs[leader_of_row[image_rows[i]]]
+            if lengths[i] > 0
             else (None, None, None)
-            for i in range(batch['batch_size'])
+            for i in range(batch_size)
         ]
         return features, dropout_features, output
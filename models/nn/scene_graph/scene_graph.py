@@ -32,26 +32,38 @@ import jactorch
 import jactorch.nn as jacnn
 
 from . import functional
+from .prroi_pool import PrRoIPool2D
 
 DEBUG = bool(int(os.getenv('DEBUG_SCENE_GRAPH', 0)))
+# whether to pool the boxes of all images at once, the per-image loop in
+# forward_serial is kept as the reference
+BATCHED = True
 
 __all__ = ['SceneGraph']
 
 
 class SceneGraph(nn.Module):
-    def __init__(self, feature_dim, output_dims, downsample_rate, relation=True):
+    def __init__(self, feature_dim, output_dims, downsample_rate, relation=True, relation_k=0):
+        """
+        With a positive relation_k, relations are only computed between each
+        object and its relation_k nearest objects, and returned in a COO
+        layout: (indices, features), indices being of shape (2, n_pairs).
+        This is a library-level option for models reading the relation
+        features, see ResNetSceneGraph.
+        """
         super().__init__()
         self.pool_size = 7
         self.feature_dim = feature_dim
         self.output_dims = output_dims
         self.downsample_rate = downsample_rate
         self.relation = relation
+        self.relation_k = relation_k
 
-        self.object_roi_pool = jacnn.PrRoIPool2D(self.pool_size, self.pool_size, 1.0 / downsample_rate)
-        self.context_roi_pool = jacnn.PrRoIPool2D(self.pool_size, self.pool_size, 1.0 / downsample_rate)
+        self.object_roi_pool = PrRoIPool2D(self.pool_size, self.pool_size, 1.0 / downsample_rate)
+        self.context_roi_pool = PrRoIPool2D(self.pool_size, self.pool_size, 1.0 / downsample_rate)
 
         if self.relation:
-            self.relation_roi_pool = jacnn.PrRoIPool2D(self.pool_size, self.pool_size, 1.0 / downsample_rate)
+            self.relation_roi_pool = PrRoIPool2D(self.pool_size, self.pool_size, 1.0 / downsample_rate)
 
         if not DEBUG:
             self.context_feature_extract = nn.Conv2d(feature_dim, feature_dim, 1)
@@ -72,13 +84,13 @@ class SceneGraph(nn.Module):
 
             self.downsample_rate = 1
             self.pool_size = 32
-            self.object_roi_pool = jacnn.PrRoIPool2D(self.pool_size, self.pool_size, 1.0 / self.downsample_rate)
-            self.context_roi_pool = jacnn.PrRoIPool2D(self.pool_size, self.pool_size, 1.0 / self.downsample_rate)
+            self.object_roi_pool = PrRoIPool2D(self.pool_size, self.pool_size, 1.0 / self.downsample_rate)
+            self.context_roi_pool = PrRoIPool2D(self.pool_size, self.pool_size, 1.0 / self.downsample_rate)
             self.context_feature_extract = gen_replicate(2)
             self.object_feature_fuse = jacnn.Identity()
 
             if self.relation:
-                self.relation_roi_pool = jacnn.PrRoIPool2D(self.pool_size, self.pool_size, 1.0 / self.downsample_rate)
+                self.relation_roi_pool = PrRoIPool2D(self.pool_size, self.pool_size, 1.0 / self.downsample_rate)
                 self.relation_feature_extract = gen_replicate(3)
                 self.relation_feature_fuse = jacnn.Identity()
 
@@ -92,6 +104,128 @@ class SceneGraph(nn.Module):
                 m.bias.data.zero_()
 
     def forward(self, input, objects, objects_length):
+        if not BATCHED and self.relation_k == 0:
+            return self.forward_serial(input, objects, objects_length)
+
+        object_features = input
+        context_features = self.context_feature_extract(input)
+
+        relation_features = None
+        if self.relation:
+            relation_features = self.relation_feature_extract(input)
+
+        # boxes of all images are pooled together, split by offsets
+        box = objects
+        lengths = objects_length.tolist()
+        offsets = [0] + objects_length.cumsum(0).tolist()[:-1]
+
+        with torch.no_grad():
+            batch_ind = torch.cat([
+                i + torch.zeros(n, 1, dtype=box.dtype, device=box.device)
+                for i, n in enumerate(lengths)
+            ])
+
+            # generate a "full-image" bounding box
+            image_h, image_w = input.size(2) * self.downsample_rate, input.size(3) * self.downsample_rate
+            full_box = box.new_tensor([0, 0, image_w, image_h])[None]
+            image_box = full_box.repeat(box.size(0), 1)
+            image_ind = torch.arange(input.size(0), dtype=box.dtype, device=box.device)[:, None]
+
+            box_context_imap = functional.generate_intersection_map(box, image_box, self.pool_size)
+
+        # all objects in an image share the context of the full image
+        image_context_features = self.context_roi_pool(
+            context_features, torch.cat([image_ind, full_box.repeat(input.size(0), 1)], dim=-1))
+        all_context_features = image_context_features[batch_ind[:, 0].long()]
+        x, y = all_context_features.chunk(2, dim=1)
+        all_object_features = self.object_feature_fuse(torch.cat([
+            self.object_roi_pool(object_features, torch.cat([batch_ind, box], dim=-1)),
+            x, y * box_context_imap
+        ], dim=1))
+
+        if self.relation:
+            with torch.no_grad():
+                if self.relation_k > 0:
+                    # the nearest neighbours within each image
+                    ids = [
+                        [offset + one for one in self.neighbour_pairs(box[offset: offset + n])]
+                        for offset, n in zip(offsets, lengths)
+                    ]
+                else:
+                    # meshgrid within each image to obtain the subject and object bounding boxes
+                    ids = [
+                        jactorch.meshgrid(offset + torch.arange(n, dtype=torch.int64, device=box.device), dim=0)
+                        for offset, n in zip(offsets, lengths)
+                    ]
+                sub_id = torch.cat([one[0].contiguous().view(-1) for one in ids])
+                obj_id = torch.cat([one[1].contiguous().view(-1) for one in ids])
+                sub_box, obj_box = box[sub_id], box[obj_id]
+
+                # union box
+                union_box = functional.generate_union_box(sub_box, obj_box)
+                rel_batch_ind = batch_ind[sub_id]
+
+                # intersection maps
+                sub_union_imap = functional.generate_intersection_map(sub_box, union_box, self.pool_size)
+                obj_union_imap = functional.generate_intersection_map(obj_box, union_box, self.pool_size)
+
+            all_relation_features = self.relation_roi_pool(relation_features, torch.cat([rel_batch_ind, union_box], dim=-1))
+            x, y, z = all_relation_features.chunk(3, dim=1)
+            all_relation_features = self.relation_feature_fuse(torch.cat([
+                all_object_features[sub_id], all_object_features[obj_id],
+                x, y * sub_union_imap, z * obj_union_imap
+            ], dim=1))
+
+        if not DEBUG:
+            all_object_features = self._norm(self.object_feature_fc(all_object_features.view(box.size(0), -1)))
+            if self.relation:
+                all_relation_features = self._norm(self.relation_feature_fc(all_relation_features.view(sub_id.size(0), -1)))
+
+        object_splits = all_object_features.split(lengths)
+        if self.relation and self.relation_k > 0:
+            n_pairs = [one[0].numel() for one in ids]
+            relation_splits = [
+                (torch.stack([sub - offset, obj - offset]), one)
+                for sub, obj, one, offset in zip(
+                    sub_id.split(n_pairs), obj_id.split(n_pairs),
+                    all_relation_features.split(n_pairs), offsets)
+            ]
+        elif self.relation:
+            relation_splits = [
+                one.view((n, n) + one.shape[1:]) if not DEBUG else one
+                for one, n in zip(all_relation_features.split([n * n for n in lengths]), lengths)
+            ]
+        else:
+            relation_splits = [None] * len(lengths)
+
+        outputs = [
+            [None, this_object_features, this_relation_features]
+            for this_object_features, this_relation_features in zip(object_splits, relation_splits)
+        ]
+        return outputs
+
+    def neighbour_pairs(self, box):
+        """
+        Pairing each object with its relation_k nearest objects (by the
+        distance between box centers), overlapping ones coming first.
+        The object itself is always included.
+
+        Output:
+            sub_id, obj_id: LongTensor, shape = (n, k)
+        """
+        n = box.size(0)
+        k = min(self.relation_k, n)
+        center = (box[:, :2] + box[:, 2:]) / 2
+        distance = (center[:, None] - center[None]).norm(dim=-1)
+        overlap = functional.box_intersection(box[:, None], box[None]) > 0
+        distance = distance - overlap.float() * (distance.max() + 1)
+        distance[torch.arange(n, device=box.device), torch.arange(n, device=box.device)] = -float('inf')
+
+        obj_id = distance.topk(k, dim=1, largest=False)[1]
+        sub_id = torch.arange(n, dtype=torch.int64, device=box.device)[:, None].expand_as(obj_id)
+        return sub_id, obj_id
+
+    def forward_serial(self, input, objects, objects_length):
         object_features = input
         context_features = self.context_feature_extract(input)
 
@@ -85,7 +85,7 @@ class Seq2seqParser():
 
     def load_checkpoint(self, load_path):
         # print('| loading checkpoint from %s' % load_path)
-        checkpoint = torch.load(load_path)
+        checkpoint = torch.load(load_path, map_location='cpu')
         self.net_params = checkpoint['net_params']
         if 'fix_embedding' in vars(self.opt): # To do: change condition input to run mode
             self.net_params['fix_embedding'] = self.opt.fix_embedding
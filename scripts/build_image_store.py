@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Decoding, square-padding and resizing all images once, into a uint8 store
+# to be read by training with --image_store
+
+import os
+import sys
+import torch
+from IPython.core import ultratb
+
+from utility.common import make_dir
+from utility.logging import Logger
+
+from scripts.utils.prepare import \
+    load_training_visual_dataset, print_args, image_store_filename
+
+sys.excepthook = ultratb.FormattedTB(
+    mode='Plain', color_scheme='Linux', call_pdb=1)
+
+
+class ImageLoader(torch.utils.data.Dataset):
+    """
+    Decoding the images in data-loading workers
+    """
+
+    def __init__(self, base_dataset, scenes):
+        self.base_dataset = base_dataset
+        self.scenes = scenes
+
+    def __getitem__(self, index):
+        scene = self.scenes[index]
+        image, shape = self.base_dataset.load_image(scene['image_filename'])
+        return scene['image_id'], image, shape
+
+    def __len__(self):
+        return len(self.scenes)
+
+
+def build_image_store(args):
+    make_dir(args.cache_dir)
+    logger = Logger(args.cache_dir, is_main=True)
+    logger(' '.join(sys.argv))
+    print_args(args, logger)
+
+    logger('Loading sceneGraphs')
+    with logger.levelup():
+        filename = os.path.join(args.dataset_dir, 'sceneGraphs.pkl')
+        visual_dataset = load_training_visual_dataset(
+            args, filename, logger, 0)
+        visual_dataset.match_images(args.image_dir)
+    base_dataset = visual_dataset.base_dataset
+
+    filename = image_store_filename(args)
+    scale = args.image_scale
+    logger(f'Storing images of shape (3, {scale}, {scale}) to {filename}')
+    base_dataset.init_image_store(filename, create=True)
+
+    # resuming from the images already processed
+    todo = {}
+    for index in visual_dataset.indexes:
+        scene = visual_dataset.sceneGraphs[index]
+        if scene['image_id'] not in todo and \
+                base_dataset.read_image_store(scene['image_id'])[2] == 0:
+            todo[scene['image_id']] = scene
+    logger(f'{len(todo)} images to go', resume=True)
+
+    loader = torch.utils.data.DataLoader(
+        ImageLoader(base_dataset, list(todo.values())),
+        batch_size=args.batch_size, num_workers=args.num_workers,
+        collate_fn=list,
+    )
+    for batch in logger.tqdm(loader):
+        for image_id, image, shape in batch:
+            base_dataset.save_image_store(image_id, image, shape)
+    base_dataset.open_store(filename, 'r+').flush()
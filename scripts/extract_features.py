@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Extracting the frozen backbone features of all images offline, to be read
+# by training with --feature_store
+
+
+import os
+import sys
+import torch
+from IPython.core import ultratb
+
+from utility.common import make_dir
+from utility.logging import Logger
+from models.nn.scene_graph import build_trunk
+
+from scripts.utils.prepare import \
+    load_training_visual_dataset, print_args, feature_store_filename, \
+    load_image_store
+
+sys.excepthook = ultratb.FormattedTB(
+    mode='Plain', color_scheme='Linux', call_pdb=1)
+
+
+def extract_features(args):
+    make_dir(args.cache_dir)
+    logger = Logger(args.cache_dir, is_main=True)
+    logger(' '.join(sys.argv))
+    print_args(args, logger)
+    device = args.cudas[0]
+
+    logger('Loading sceneGraphs')
+    with logger.levelup():
+        filename = os.path.join(args.dataset_dir, 'sceneGraphs.pkl')
+        visual_dataset = load_training_visual_dataset(
+            args, filename, logger, 0)
+        visual_dataset.match_images(args.image_dir)
+        if args.image_store:
+            load_image_store(args, visual_dataset, logger)
+    base_dataset = visual_dataset.base_dataset
+
+    trunk = build_trunk().to(device)
+    trunk.eval()
+    scale = args.image_scale
+    with torch.no_grad():
+        feature_shape = trunk(
+            torch.zeros(1, 3, scale, scale, device=device)).shape[1:]
+
+    filename = feature_store_filename(args, trunk)
+    logger(f'Extracting features of shape {tuple(feature_shape)} '
+           f'to {filename}')
+    base_dataset.init_cache(filename, feature_shape)
+
+    # resuming from the images already processed
+    todo = []
+    for index in visual_dataset.indexes:
+        image_id = visual_dataset.sceneGraphs[index]['image_id']
+        if base_dataset.read_cache(image_id)[2] == 0:
+            todo.append(index)
+    logger(f'{len(todo)} images to go', resume=True)
+
+    def run_batch(indexes):
+        scenes = [visual_dataset.sceneGraphs[index] for index in indexes]
+        images, shapes = zip(*[
+            base_dataset.read_image(
+                scene['image_filename'], scene['image_id'])
+            for scene in scenes
+        ])
+        with torch.no_grad():
+            features = trunk(torch.Tensor(images).to(device))
+        features = features.half().cpu().numpy()
+        for scene, feature, shape in zip(scenes, features, shapes):
+            base_dataset.save_cache(scene['image_id'], feature, shape)
+
+    pbar = logger.tqdm(range(0, len(todo), args.batch_size))
+    for i in pbar:
+        run_batch(todo[i: i + args.batch_size])
+    base_dataset.open_cache('r+').flush()
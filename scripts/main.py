@@ -32,6 +32,12 @@ def main():
     elif args.mode == 'output-dataset':
         from scripts import output_dataset
         output_dataset.output_dataset(args)
+    elif args.mode == 'extract-features':
+        from scripts import extract_features
+        extract_features.extract_features(args)
+    elif args.mode == 'build-image-store':
+        from scripts import build_image_store
+        build_image_store.build_image_store(args)
 
 
 if __name__ == '__main__':
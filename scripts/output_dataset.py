@@ -232,7 +232,7 @@ def output_dataset(args):
     processes = []
 
     for i in range(0, args.num_parallel):
-        device = args.cudas[i * args.num_gpus // args.num_parallel]
+        device = args.cudas[i * len(args.cudas) // args.num_parallel]
         p = ctx.Process(target=output_one,
                         args=(args, i, device, i == 0))
         processes.append(p)
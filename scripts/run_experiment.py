@@ -25,23 +25,29 @@ from utility.common import init_seed, plt
 from utility.logging import Logger
 from utility.recording import AverageGroup
 from utility.load_ckpt import download_ckpt
+from models.nn.framework.numerics import guard
 
 from scripts.utils import register
 from scripts.utils.prepare import\
     load_training_visual_dataset, \
     print_args, load_model, load_for_schedule, load_ref_dataset, \
-    questions_directly, get_parser
+    questions_directly, get_parser, load_feature_store, load_image_store
 from scripts.utils.train import train
+from scripts.utils.export import \
+    export_model, benchmark_export, CompiledInference
+from scripts.utils.quantize import regression_report
 
 
 def ready_go(args, index, message, control, device, is_main):
     # Initialization
     sys.excepthook = ultratb.FormattedTB(
         mode='Plain', color_scheme='Linux', call_pdb=is_main)
-    torch.cuda.set_device(device)
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
     local_dir = os.path.join(args.local_log_dir, str(index))
 
     init_seed(args.random_seed, index)
+    guard.configure(args.numerics_guard, args.guard_every, args.guard_buffer)
     logger = Logger(local_dir, is_main, args.silent)
     logger(' '.join(sys.argv))
     print_args(args, logger)
@@ -63,6 +69,8 @@ def ready_go(args, index, message, control, device, is_main):
             args, filename, logger, index)
         visual_dataset.set_inputs(args.visual_inputs)
         visual_dataset.match_images(args.image_dir)
+        if args.image_store:
+            load_image_store(args, visual_dataset, logger)
     if 'test_ref' in args.in_epoch:
         with logger.levelup():
             ref_dataset = load_ref_dataset(
@@ -107,6 +115,12 @@ def ready_go(args, index, message, control, device, is_main):
     logger('Building model')
     with logger.levelup():
         model = load_model(args, tools, device, logger)
+        if args.intersection_method == 'table':
+            error = model.embedding.logit_fn.table['error']
+            logger(f'Intersection table: relative error of ln Pr '
+                   f'{error["value"]:.2e}, of its derivative on cos '
+                   f'{error["cos"]:.2e}, {error["exact"]:.2%} of the cells '
+                   f'by the closed form')
 
     # recording
     logger('Building recordings')
@@ -144,6 +158,24 @@ def ready_go(args, index, message, control, device, is_main):
         ckpt = download_ckpt(args, args.task, args.name, index, is_main)
         coach.load_partial(ckpt)
     coach.tools.operations.register_special()
+    if args.feature_store:
+        load_feature_store(args, visual_dataset, model, logger)
+
+    if args.export_dir != '':
+        export_dir = os.path.join(args.export_dir, str(index))
+        logger('Exporting for inference')
+        with logger.levelup():
+            artifacts = export_model(
+                model, question_parser, export_dir, args, logger)
+            compiled = CompiledInference(export_dir, device)
+            benchmark_export(artifacts, compiled, 20, logger)
+        return
+
+    if args.quantize_int8:
+        logger('Quantizing to int8')
+        with logger.levelup():
+            regression_report(coach, visual_dataset, args, logger)
+        return
 
     # go baby go
     if args.ipython and is_main:
@@ -154,6 +186,11 @@ def ready_go(args, index, message, control, device, is_main):
 
 
 def run(args):
+    if args.intersection_method == 'table':
+        # building the table once, to be shared by all parallel trials
+        from models.nn.framework.embedding import load_table
+        load_table(args, 'cpu')
+
     ctx = mp.get_context('spawn')
 
     message = [ctx.Queue() for i in range(args.num_parallel)]
@@ -161,7 +198,7 @@ def run(args):
     processes = []
 
     for i in range(0, args.num_parallel):
-        device = args.cudas[i * args.num_gpus // args.num_parallel]
+        device = args.cudas[i * len(args.cudas) // args.num_parallel]
         p = ctx.Process(target=ready_go,
                         args=(args, i, message[i], control[i],
                               device, i == 0))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Measuring the throughput of the cpu backends of PrRoIPool2D and the
+# half-Gaussian intersection under different numbers of threads, and
+# comparing PrRoIPool2D against the CUDA extension when a gpu is present.
+# Run as:
+#   python scripts/snippets/benchmark_cpu_backend.py --threads 1 4 16
+
+
+import sys
+import time
+import argparse
+import torch
+
+sys.path.append('.')
+
+from models.nn.scene_graph.prroi_pool import prroi_pool2d, PrRoIPool2D
+from models.nn.framework.functional import get_LnIntersection
+
+
+def random_rois(n_images, n_rois, image_size):
+    corners = torch.rand(n_images * n_rois, 2, 2) * image_size
+    boxes = torch.cat([corners.min(1)[0], corners.max(1)[0]], dim=-1)
+    batch_ind = torch.arange(n_images).repeat_interleave(n_rois)
+    return torch.cat([batch_ind[:, None].float(), boxes], dim=-1)
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start) / repeat
+
+
+def bench_pool(args):
+    features = torch.randn(args.n_images, 256, 14, 14)
+    rois = random_rois(args.n_images, args.n_rois, 14 * 16)
+
+    def run():
+        with torch.no_grad():
+            prroi_pool2d(features, rois, 7, 7, 1 / 16)
+
+    n_rois = rois.size(0)
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        elapsed = timeit(run, args.repeat)
+        print(f'{"prroi_pool":<14}{threads:>8}{elapsed * 1000:>12.3f}ms'
+              f'{n_rois / elapsed:>14.1f} rois/s')
+
+    if torch.cuda.is_available():
+        pool = PrRoIPool2D(7, 7, 1 / 16)
+        reference = pool(features.cuda(), rois.cuda()).cpu()
+        output = pool(features, rois)
+        error = (reference - output).abs().max().item()
+        print(f'max error against the CUDA extension: {error:.3e}')
+
+
+def bench_intersection(args):
+    fn = get_LnIntersection(
+        args.sample_size, 10, 'cpu', False, method=args.method)
+    x = torch.rand(args.n_concepts) * 5
+    y = torch.rand(args.n_concepts) * 5
+    cos = torch.rand(args.n_concepts, args.n_concepts) * 2 - 1
+
+    def run():
+        with torch.no_grad():
+            fn(x, y, cos)
+
+    n_pairs = args.n_concepts ** 2
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        elapsed = timeit(run, args.repeat)
+        print(f'{"intersection":<14}{threads:>8}{elapsed * 1000:>12.3f}ms'
+              f'{n_pairs / elapsed:>14.1f} pairs/s')
+
+
+def main():
+    args = Arg().parse_args()
+    torch.manual_seed(args.seed)
+    print(f'{"name":<14}{"threads":>8}{"time":>14}{"throughput":>20}')
+    bench_pool(args)
+    bench_intersection(args)
+
+
+def Arg():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=[1, torch.get_num_threads()])
+    parser.add_argument('--n_images', type=int, default=10)
+    parser.add_argument('--n_rois', type=int, default=10,
+                        help='num of rois on each image')
+    parser.add_argument('--n_concepts', type=int, default=100)
+    parser.add_argument('--sample_size', type=int, default=1000)
+    parser.add_argument('--method', type=str, default='riemann',
+                        choices=['riemann', 'owen', 'quadrature'])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+if __name__ == '__main__':
+    main()
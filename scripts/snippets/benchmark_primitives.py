@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Comparing the fused primitive kernels against the original ones, on speed
+# and on the relative errors of the values / gradients they output against the
+# original ones evaluated in float64. Importing the module compiles the fused
+# kernels, so a TorchScript error shows up here first. Run as:
+#   python scripts/snippets/benchmark_primitives.py --size 1000000
+
+
+import sys
+import time
+import argparse
+import torch
+
+sys.path.append('.')
+
+from models.nn.framework import sub_functional
+
+
+def primitives():
+    return {
+        'ln_pdf': lambda x: sub_functional.ln_pdf(x),
+        'ln_cdf': lambda x: sub_functional.ln_cdf(x),
+        'stable_softminus': lambda x: sub_functional.stable_softminus(
+            -x.abs() - 1e-6),
+        'logit_ln': lambda x: sub_functional.logit_ln(-x.abs()),
+    }
+
+
+def run(fn, x, fused, backward):
+    sub_functional.FUSED = fused
+    x = x.detach().requires_grad_(backward)
+    output = fn(x)
+    grad = None
+    if backward:
+        output.sum().backward()
+        grad = x.grad
+    return output.detach(), grad
+
+
+def timeit(fn, x, fused, backward, repeat, device):
+    for _ in range(2):
+        run(fn, x, fused, backward)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        run(fn, x, fused, backward)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat
+
+
+def max_error(a, reference):
+    if a is None:
+        return 0.
+    reference = reference.to(a.dtype)
+    both = torch.isfinite(a) & torch.isfinite(reference)
+    if (torch.isfinite(a) != torch.isfinite(reference)).any():
+        return float('inf')
+    error = (a[both] - reference[both]).abs() / \
+        reference[both].abs().clamp(min=1)
+    return float(error.max())
+
+
+def main():
+    args = Arg().parse_args()
+    torch.manual_seed(args.seed)
+    dtype = torch.double if args.double else torch.float
+    x = (torch.randn(args.size, dtype=dtype) * args.scale).to(args.device)
+
+    print(f'{"name":<18}{"pass":<10}{"original":>12}{"fused":>12}'
+          f'{"speedup":>10}{"error":>12}{"fused error":>12}')
+    for name, fn in primitives().items():
+        for backward in (False, True):
+            reference = run(fn, x.double(), False, backward)
+            original = run(fn, x, False, backward)
+            output = run(fn, x, True, backward)
+            error_original = max(max_error(original[0], reference[0]),
+                                 max_error(original[1], reference[1]))
+            error_fused = max(max_error(output[0], reference[0]),
+                              max_error(output[1], reference[1]))
+
+            time_original = timeit(fn, x, False, backward,
+                                   args.repeat, args.device)
+            time_fused = timeit(fn, x, True, backward,
+                                args.repeat, args.device)
+            print(f'{name:<18}{"backward" if backward else "forward":<10}'
+                  f'{time_original * 1000:>10.3f}ms{time_fused * 1000:>10.3f}ms'
+                  f'{time_original / time_fused:>9.2f}x'
+                  f'{error_original:>12.3e}{error_fused:>12.3e}')
+
+    sub_functional.FUSED = True
+
+
+def Arg():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument('--scale', type=float, default=10,
+                        help='std of the sampled inputs')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--device', type=str, default='cpu',
+                        choices=['cpu', 'cuda'])
+    parser.add_argument('--double', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+if __name__ == '__main__':
+    main()
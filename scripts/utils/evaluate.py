@@ -77,6 +77,20 @@ def accuracy_by_type(outputs, data, args):
 # RW: Right/Wrong annotations
 
 
+def RW_by_type(outputs, data, args):
+    types = set(data['type'])
+    batch_size = len(data['type'])
+    return {
+        q_type: RW_given_index(
+            outputs, data,
+            [index for index in range(batch_size)
+             if data['type'][index] == q_type],
+            args
+        )
+        for q_type in types
+    }
+
+
 def total_RW(outputs, data, args):
     return RW_given_index(
         outputs, data, list(range(len(data['type']))), args
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Exporting the graph-able parts of a trained model and its question parser
+# as TorchScript (and optionally ONNX) artifacts, and running them for
+# inference
+
+import os
+import time
+import torch
+import torch.nn as nn
+
+from utility.common import make_dir
+
+
+class GreedyParser(nn.Module):
+    """
+    The greedy decoding of the operation and argument seq2seq nets of a
+    Seq2seqParser, on question batches already sorted by length
+
+    Input:
+        x: LongTensor, shape = (batch, length), encoded questions
+        lengths: LongTensor, shape = (batch,)
+
+    Output:
+        op, arg: LongTensor, shape = (batch, max_length)
+    """
+
+    def __init__(self, seq2seq_op, seq2seq_arg, variable_lengths):
+        super().__init__()
+        self.seq2seq_op = seq2seq_op
+        self.seq2seq_arg = seq2seq_arg
+        self.variable_lengths = variable_lengths
+
+    def decode(self, seq2seq, x, lengths):
+        encoder, decoder = seq2seq.encoder, seq2seq.decoder
+        embedded = encoder.embedding(x)
+        if self.variable_lengths:
+            embedded = nn.utils.rnn.pack_padded_sequence(
+                embedded, lengths, batch_first=True)
+        encoder_outputs, encoder_hidden = encoder.rnn(embedded)
+        if self.variable_lengths:
+            encoder_outputs, _ = nn.utils.rnn.pad_packed_sequence(
+                encoder_outputs, batch_first=True)
+
+        hidden = decoder._init_state(encoder_hidden)
+        symbols = x.new_full((x.size(0), 1), decoder.start_id)
+        outputs = []
+        for _ in range(decoder.max_length):
+            output, hidden, _ = decoder.forward_step(
+                symbols, hidden, encoder_outputs)
+            symbols = output.topk(1)[1].view(x.size(0), -1)
+            outputs.append(symbols)
+        return torch.cat(outputs, 1)
+
+    def forward(self, x, lengths):
+        return self.decode(self.seq2seq_op, x, lengths), \
+            self.decode(self.seq2seq_arg, x, lengths)
+
+
+def first_linear(module):
+    for one in module.modules():
+        if isinstance(one, nn.Linear):
+            return one
+    raise Exception(f'no linear layer found in {module}')
+
+
+def example_questions(parser, batch_size, length=10):
+    x = torch.randint(
+        3, len(parser.tools.words), (batch_size, length)).long()
+    x[:, -1] = parser.end_id
+    lengths = torch.full((batch_size,), length).long()
+    return x.to(parser.device), lengths
+
+
+def export_model(model, parser, export_dir, args, logger):
+    """
+    Tracing the vision trunk, feature_mlp, the metaconcept head and the
+    parser into TorchScript files under export_dir, together with the
+    concept embeddings evaluated once.
+    """
+    make_dir(export_dir)
+    model.eval()
+    device = model.device
+    scale = args.image_scale
+    artifacts = {}
+
+    with torch.no_grad():
+        if getattr(model, 'trunk', None) is not None:
+            artifacts['trunk'] = (
+                model.trunk, (torch.zeros(1, 3, scale, scale).to(device),))
+        if hasattr(model, 'feature_mlp'):
+            artifacts['feature_mlp'] = (
+                model.feature_mlp,
+                (torch.zeros(1, args.feature_dim).to(device),))
+        if hasattr(model, 'embedding') and \
+                hasattr(model.embedding, 'metaconcept_subnet'):
+            head = model.embedding.metaconcept_subnet
+            artifacts['metaconcept_head'] = (
+                head,
+                (torch.zeros(1, first_linear(head).in_features).to(device),))
+            torch.save(
+                model.embedding.all_concept_embeddings().cpu(),
+                os.path.join(export_dir, 'concept_embeddings.pth'))
+        if parser is not None:
+            parser.seq2seq_op.eval()
+            parser.seq2seq_arg.eval()
+            artifacts['parser'] = (
+                GreedyParser(parser.seq2seq_op, parser.seq2seq_arg,
+                             parser.variable_lengths),
+                example_questions(parser, 2))
+
+        for name, (module, example) in artifacts.items():
+            filename = os.path.join(export_dir, f'{name}.pt')
+            torch.jit.trace(module, example, check_trace=False).save(filename)
+            logger(f'Exported {name} to {filename}')
+            if args.export_onnx and name != 'parser':
+                filename = os.path.join(export_dir, f'{name}.onnx')
+                torch.onnx.export(module, example, filename)
+                logger(f'Exported {name} to {filename}')
+
+    return artifacts
+
+
+class CompiledInference:
+    """
+    Loading the exported artifacts, and running them with no autograd
+    bookkeeping
+    """
+
+    def __init__(self, export_dir, device):
+        self.device = device
+        self.modules = {}
+        for filename in os.listdir(export_dir):
+            name, ext = os.path.splitext(filename)
+            if ext == '.pt':
+                self.modules[name] = torch.jit.load(
+                    os.path.join(export_dir, filename), map_location=device)
+        filename = os.path.join(export_dir, 'concept_embeddings.pth')
+        if os.path.exists(filename):
+            self.concept_embeddings = torch.load(
+                filename, map_location=device)
+
+    def __call__(self, name, *inputs):
+        with torch.no_grad():
+            return self.modules[name](*inputs)
+
+    def __contains__(self, name):
+        return name in self.modules
+
+
+def benchmark_export(artifacts, compiled, repeat, logger):
+    """
+    Comparing the latency of the eager modules against the compiled ones,
+    on the examples they are exported with, and a batch of 16 of them
+    """
+    def timeit(fn, example):
+        with torch.no_grad():
+            fn(*example)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start = time.time()
+            for _ in range(repeat):
+                fn(*example)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        return (time.time() - start) / repeat
+
+    def batched(example, n):
+        return tuple(one.repeat((n,) + (1,) * (one.dim() - 1))
+                     for one in example)
+
+    logger(f'{"name":<18}{"batch":>6}{"eager":>12}{"compiled":>12}'
+           f'{"speedup":>10}{"items/s":>12}')
+    for name, (module, example) in artifacts.items():
+        for batch_size in (1, 16):
+            inputs = batched(example, batch_size)
+            time_eager = timeit(module, inputs)
+            time_compiled = timeit(
+                lambda *x: compiled(name, *x), inputs)
+            n = inputs[0].size(0)
+            logger(f'{name:<18}{n:>6}'
+                   f'{time_eager * 1000:>10.3f}ms'
+                   f'{time_compiled * 1000:>10.3f}ms'
+                   f'{time_eager / time_compiled:>9.2f}x'
+                   f'{n / time_compiled:>12.1f}', resume=True)
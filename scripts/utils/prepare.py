@@ -18,6 +18,7 @@ from dataset.visual_dataset.utils.sceneGraph_loader import \
     load_multiple_sceneGraphs
 from utility.common import load, make_dir
 from utility.cache import Cache
+from models.nn.framework.bert_cache import checkpoint_hash
 from reason.models.parser import Seq2seqParser
 from . import register
 
@@ -94,6 +95,49 @@ def load_model(args, tools, device, logger):
     return model
 
 
+def feature_store_filename(args, trunk):
+    """
+    The feature store is keyed by the trunk weights and the image scale
+    """
+    return os.path.join(
+        args.cache_dir,
+        f'{args.task}_features_{checkpoint_hash(trunk)}_'
+        f'{args.image_scale}.h5'
+    )
+
+
+def load_feature_store(args, visual_dataset, model, logger):
+    """
+    Making the visual dataset read frozen trunk features instead of images
+    """
+    if not args.fix_resnet:
+        raise Exception('feature store requires --fix_resnet')
+    if getattr(model, 'trunk', None) is None:
+        raise Exception(f'no visual trunk in model {args.model}')
+    filename = feature_store_filename(args, model.trunk)
+    logger(f'Using feature store: {filename}')
+    visual_dataset.init_cache(filename)
+    visual_dataset.set_inputs([
+        'feature' if one == 'image' else one
+        for one in args.visual_inputs
+    ])
+
+
+def image_store_filename(args):
+    return os.path.join(
+        args.cache_dir, f'{args.task}_images_{args.image_scale}.h5')
+
+
+def load_image_store(args, visual_dataset, logger):
+    """
+    Making the visual dataset read preprocessed images from the image store
+    instead of decoding them
+    """
+    filename = image_store_filename(args)
+    logger(f'Using image store: {filename}')
+    visual_dataset.init_image_store(filename)
+
+
 def load_for_schedule(schedule, visual_dataset, tools):
     for stage in schedule:
         for dataset in stage['question_splits'].values():
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Int8 quantized cpu inference: static quantization of the resnet trunk,
+# calibrated on the visual dataset, and dynamic quantization of the linear
+# and LSTM layers
+
+import copy
+import random
+import numpy as np
+import torch
+import torch.nn as nn
+
+from . import evaluate
+from .train import run_batch
+
+
+def check_quantization(device):
+    if not hasattr(torch, 'quantization'):
+        raise Exception('int8 quantization requires pytorch >= 1.3')
+    if torch.device(device).type != 'cpu':
+        raise Exception('int8 quantized inference only runs on cpu')
+
+
+class QuantizableBlock(nn.Module):
+    """
+    A residual block of the trunk, with the residual addition made
+    quantizable
+    """
+
+    def __init__(self, block):
+        super().__init__()
+        self.block = block
+        self.add = nn.quantized.FloatFunctional()
+
+    def fuse(self):
+        block = self.block
+        torch.quantization.fuse_modules(
+            block, [['conv1', 'bn1'], ['conv2', 'bn2']], inplace=True)
+        if block.downsample is not None:
+            torch.quantization.fuse_modules(
+                block.downsample, [['0', '1']], inplace=True)
+
+    def forward(self, x):
+        block = self.block
+        out = block.relu(block.bn1(block.conv1(x)))
+        out = block.bn2(block.conv2(out))
+        residual = x if block.downsample is None else block.downsample(x)
+        return block.relu(self.add.add(out, residual))
+
+
+class QuantizableTrunk(nn.Module):
+    """
+    The resnet34 trunk up to layer3, between a pair of quant / dequant stubs
+    """
+
+    def __init__(self, trunk):
+        super().__init__()
+        trunk = copy.deepcopy(trunk).eval()
+        self.quant = torch.quantization.QuantStub()
+        self.conv1, self.bn1 = trunk.conv1, trunk.bn1
+        self.relu, self.maxpool = trunk.relu, trunk.maxpool
+        self.layers = nn.Sequential(*[
+            QuantizableBlock(block)
+            for layer in (trunk.layer1, trunk.layer2, trunk.layer3)
+            for block in layer
+        ])
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def fuse(self):
+        torch.quantization.fuse_modules(
+            self, [['conv1', 'bn1', 'relu']], inplace=True)
+        for block in self.layers:
+            block.fuse()
+
+    def forward(self, x):
+        x = self.quant(x)
+        x = self.maxpool(self.relu(self.bn1(self.conv1(x))))
+        x = self.layers(x)
+        return self.dequant(x)
+
+
+def calibration_images(visual_dataset, size):
+    base_dataset = visual_dataset.base_dataset
+    indexes = random.sample(
+        visual_dataset.indexes, min(size, len(visual_dataset)))
+    for index in indexes:
+        scene = visual_dataset.sceneGraphs[index]
+        image, _ = base_dataset.read_image(
+            scene['image_filename'], scene['image_id'])
+        yield torch.Tensor(image)[None]
+
+
+def quantize_trunk(trunk, visual_dataset, size, logger):
+    """
+    Static int8 quantization of the trunk, with the activation ranges
+    calibrated on a sample of images
+    """
+    quantized = QuantizableTrunk(trunk)
+    quantized.fuse()
+    quantized.qconfig = torch.quantization.get_default_qconfig('fbgemm')
+    torch.quantization.prepare(quantized, inplace=True)
+
+    logger(f'Calibrating on {size} images')
+    with torch.no_grad():
+        for image in calibration_images(visual_dataset, size):
+            quantized(image)
+    torch.quantization.convert(quantized, inplace=True)
+    return quantized
+
+
+def dynamic_qconfig_spec(model, skip=('embedding.metaconcept_subnet',)):
+    """
+    The Linear and LSTM layers to quantize dynamically, by name. Layers under
+    `skip` are left in float, as factorized_subnet reads the weights of the
+    metaconcept subnet directly.
+    """
+    return {
+        name: torch.quantization.default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, (nn.Linear, nn.LSTM)) and
+        not any(name == one or name.startswith(one + '.') for one in skip)
+    }
+
+
+def quantize_model(model, visual_dataset, args, logger):
+    """
+    Quantizing the model in place for cpu inference. The cached object
+    features of the float model are invalidated.
+    """
+    check_quantization(model.device)
+    model.eval()
+    if getattr(model, 'trunk', None) is not None and not args.feature_store:
+        logger('Statically quantizing the trunk')
+        with logger.levelup():
+            model.set_trunk(quantize_trunk(
+                model.trunk, visual_dataset, args.calibration_size, logger))
+    logger('Dynamically quantizing linear and LSTM layers')
+    torch.quantization.quantize_dynamic(
+        model, dynamic_qconfig_spec(model), dtype=torch.qint8, inplace=True)
+    if hasattr(model, 'vision_version'):
+        model.vision_version += 1
+    return model
+
+
+def quantize_parser(parser):
+    check_quantization(parser.device)
+    for name in ('seq2seq_op', 'seq2seq_arg'):
+        setattr(parser, name, torch.quantization.quantize_dynamic(
+            getattr(parser, name), {nn.Linear, nn.LSTM}, dtype=torch.qint8))
+
+
+def parse_questions(parser, dataloader):
+    programs = []
+    with torch.no_grad():
+        for data in dataloader:
+            programs.extend(parser.translate(data['question']))
+    return programs
+
+
+def agreement(programs, reference):
+    return np.mean([one == another
+                    for one, another in zip(programs, reference)])
+
+
+def accuracy_by_type(model, dataloader, args):
+    """
+    Output:
+        a dict from question types to their accuracies on the dataloader
+    """
+    right = {}
+    model.eval()
+    with torch.no_grad():
+        for data in dataloader:
+            _, outputs = run_batch(data, model, args)
+            for q_type, one in evaluate.RW_by_type(
+                    outputs, data, args).items():
+                right.setdefault(q_type, []).append(one)
+    return {q_type: np.concatenate(one).mean()
+            for q_type, one in right.items()}
+
+
+def regression_report(coach, visual_dataset, args, logger):
+    """
+    Quantizing the model and the parser of the coach, and reporting the
+    accuracy of each question type before and after. The evaluation runs on
+    the ground-truth programs, so the parser is reported separately, by the
+    fraction of questions it translates to the same programs as before.
+    """
+    dataloaders = {'val': coach.val, 'test': coach.test}
+    parser = coach.question_parser
+    before = {split: accuracy_by_type(coach.model, dataloader, args)
+              for split, dataloader in dataloaders.items()}
+    if parser is not None:
+        programs = {split: parse_questions(parser, dataloader)
+                    for split, dataloader in dataloaders.items()}
+
+    quantize_model(coach.model, visual_dataset, args, logger)
+    if parser is not None:
+        quantize_parser(parser)
+
+    after = {split: accuracy_by_type(coach.model, dataloader, args)
+             for split, dataloader in dataloaders.items()}
+
+    logger(f'{"split":<8}{"type":<18}{"fp32":>10}{"int8":>10}'
+           f'{"change":>10}')
+    for split in dataloaders:
+        for q_type in sorted(before[split]):
+            acc_before = before[split][q_type]
+            acc_after = after[split].get(q_type, float('nan'))
+            logger(f'{split:<8}{q_type:<18}{acc_before:>10.4f}'
+                   f'{acc_after:>10.4f}{acc_after - acc_before:>+10.4f}',
+                   resume=True)
+    if parser is not None:
+        for split, dataloader in dataloaders.items():
+            same = agreement(
+                parse_questions(parser, dataloader), programs[split])
+            logger(f'{split}: {same:.4f} of the questions parsed to the '
+                   'same programs by the int8 parser')
+    return before, after
@@ -12,35 +12,56 @@
 #
 # codes for running training
 
+import os
+import numpy as np
 import torch
 from . import evaluate
 from .referential import ref_epoch
 # from utility.common import detach
 from dataset.question_dataset.utils import program_utils
-
-
-def loss_classification(loss, confidence, gt_class, args):
-    yes = (gt_class == 1) * confidence
-    no = (gt_class == 0) * confidence
-    yes_num = yes.sum()
-    no_num = no.sum()
+from models.nn.framework.numerics import guard
+
+
+def loss_classification_batch(losses, confidences, gt_classes, args):
+    """
+    The classification losses of a batch of questions, the mean loss over
+    the confidence-weighted yes / no annotations of each question, averaged
+    between yes and no if balance_classification. The losses and the masks
+    are padded into (n_questions, n_objects, n_concepts), so that the
+    reductions run once for the batch
+    """
+    shape = (len(losses),
+             max(one.shape[0] for one in losses),
+             max(one.shape[1] for one in losses))
+    loss = losses[0].new_zeros(shape)
+    yes = np.zeros(shape)
+    no = np.zeros(shape)
+    for k, (one, confidence, gt_class) in enumerate(
+            zip(losses, confidences, gt_classes)):
+        n, m = one.shape
+        loss[k, :n, :m] = one
+        yes[k, :n, :m] = (gt_class == 1) * confidence
+        no[k, :n, :m] = (gt_class == 0) * confidence
 
     yes_tensor = torch.Tensor(yes).to(loss.device)
     no_tensor = torch.Tensor(no).to(loss.device)
-    yes_loss = (loss * yes_tensor).sum()
-    no_loss = (loss * no_tensor).sum()
+    yes_num = yes_tensor.sum((1, 2))
+    no_num = no_tensor.sum((1, 2))
+    yes_loss = (loss * yes_tensor).sum((1, 2))
+    no_loss = (loss * no_tensor).sum((1, 2))
 
     if args.balance_classification:
-        if no_num == 0:
-            output = yes_loss / yes_num
-        elif yes_num == 0:
-            output = no_loss / no_num
-        else:
-            output = (yes_loss / yes_num + no_loss / no_num) / 2
+        # clamping the counts, so that the unused branches stay finite
+        yes_mean = yes_loss / yes_num.clamp(min=1e-10)
+        no_mean = no_loss / no_num.clamp(min=1e-10)
+        output = torch.where(
+            no_num == 0, yes_mean,
+            torch.where(yes_num == 0, no_mean, (yes_mean + no_mean) / 2)
+        )
     else:
         output = (yes_loss + no_loss) / (yes_num + no_num)
 
-    return output
+    return list(output)
 
 
 def loss_plain(loss, confidence, category, args):
@@ -60,14 +81,22 @@ def object_penalty(objects_in_one, penalty_weight):
 
 
 def calculate_loss(losses, data, objects, args):
+    classification = [i for i, q_type in enumerate(data['type'])
+                      if q_type == 'classification']
+    classification_losses = {}
+    if len(classification) > 0:
+        classification_losses = dict(zip(
+            classification, loss_classification_batch(
+                [losses[i] for i in classification],
+                [data['confidence'][i] for i in classification],
+                [data['answer'][i] for i in classification],
+                args,
+            )))
+
     processed = []
     for i, loss in enumerate(losses):
-        q_type = data['type'][i]
-        if q_type == 'classification':
-            this_loss = loss_classification(
-                loss, data['confidence'][i],
-                data['answer'][i], args
-            )
+        if i in classification_losses:
+            this_loss = classification_losses[i]
         else:
             this_loss = loss_plain(
                 loss, data['confidence'][i],
@@ -98,6 +127,22 @@ def max_grad(parameters):
     return max_grad
 
 
+def flush_guard(coach):
+    """
+    Checking the deferred numerical flags of this step, dumping the recorded
+    violations into the local directory if any. Called after each training
+    or evaluation step, and after the other forward passes of an epoch;
+    the guard also flushes itself once its pending flags pile up.
+    """
+    try:
+        guard.flush()
+    except Exception:
+        filename = os.path.join(coach.local_dir, 'numerics_violations.pth')
+        guard.dump(filename)
+        coach.logger(f'Numerical violations dumped to {filename}')
+        raise
+
+
 def any_epoch(coach, prepare, recording, dataloader, reset, is_train):
     prepare()
     args = coach.args
@@ -126,6 +171,7 @@ def any_epoch(coach, prepare, recording, dataloader, reset, is_train):
                 model.update()
             else:
                 loss, outputs = run_batch(data, model, args)
+            flush_guard(coach)
 
             analyze_result = {'loss': loss.item()}
             analyze_result.update(evaluate.eval(outputs, data, args))
@@ -142,9 +188,34 @@ def any_epoch(coach, prepare, recording, dataloader, reset, is_train):
             inner()
 
 
+def tune_intersection(coach, args):
+    errors = coach.model.tune_intersection(args.quadrature_tolerance)
+    if errors is None:
+        return
+    logit_fn = coach.model.embedding.logit_fn
+    coach.logger(f'Quadrature nodes tuned to {logit_fn.n_nodes}, '
+                 f'error budget on ln Pr: {logit_fn.error_budget:.2e}')
+    coach.logger(errors, resume=True, pretty=True)
+
+
+def precision_report(coach, args):
+    report = coach.model.precision_report()
+    if report is None:
+        return
+    coach.logger(f'{args.grid_precision} grid on {report["low"]:.2%} of '
+                 f'the pairs, error of ln Pr against float64: '
+                 f'max {report["max"]:.2e}, mean {report["mean"]:.2e}')
+
+
 def run_epoch(coach, args, i_epoch):
     with coach.logger.levelup():
         coach.model.visualize(coach.local_dir, coach.plt)
+        if args.intersection_method == 'quadrature' and \
+                args.quadrature_tolerance > 0:
+            tune_intersection(coach, args)
+        if args.grid_precision != 'full':
+            precision_report(coach, args)
+        flush_guard(coach)
 
     coach.send(i_epoch)
 
@@ -189,6 +260,7 @@ def run_epoch(coach, args, i_epoch):
             coach.logger('Testing by Referential Expression')
             ref_epoch(coach, coach.model.eval, coach.ref_recording,
                       coach.ref_dataset)
+            flush_guard(coach)
             coach.logger('Visualizing plots')
             coach.send(coach.ref_recording)
 
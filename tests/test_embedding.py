@@ -0,0 +1,38 @@
+# Checks of the concept embeddings in models/nn/framework/embedding.py
+
+from types import SimpleNamespace
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('sklearn')
+
+from models.nn.framework.embedding import ConceptEmbedding
+
+
+def concept_embedding(version):
+    args = SimpleNamespace(
+        embed_dim=8, metaconcept_hidden_dim=16, init_variance=0.1,
+        intersection_method='riemann', intersection_nodes=16,
+        sample_size=1000, memory_budget=0, grid_precision='full',
+        penalty=0,
+    )
+    tools = SimpleNamespace(n_concepts=6)
+    embedding = ConceptEmbedding(args, tools, 'cpu', version)
+    embedding.init()
+    return embedding
+
+
+@pytest.mark.parametrize('version', ['v2.0', 'VCML', 'NSCL'])
+def test_determine_relation_pairs(version):
+    torch.manual_seed(0)
+    embedding = concept_embedding(version)
+    firsts = torch.LongTensor([0, 0, 1, 2, 5])
+    seconds = torch.LongTensor([1, 3, 1, 4, 0])
+    concepts1 = embedding.concept_embedding(firsts)
+    concepts2 = embedding.concept_embedding(seconds)
+
+    paired = embedding.determine_relation_pairs(concepts1, concepts2)
+    cartesian = embedding.determine_relation(concepts1, concepts2)
+
+    assert paired.shape == (5, 5)
+    assert torch.allclose(paired, cartesian.diagonal().t(), atol=1e-5)
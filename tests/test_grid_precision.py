@@ -0,0 +1,43 @@
+# Checks of the low-precision sample grid of the riemann intersection in
+# models/nn/framework/functional.py
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from models.nn.framework import functional
+from models.nn.framework.functional import \
+    HalfGaussianConditionalLogit, GRID_TOLERANCE
+
+
+def concept_vectors(n, dim, scale):
+    # a cluster of concepts, as after training, with some pointing away
+    torch.manual_seed(0)
+    vectors = torch.randn(1, dim) + torch.randn(n, dim)
+    vectors[::3] *= -1
+    return (vectors * scale).double()
+
+
+@pytest.mark.parametrize('scale', [0.05, 0.1, 0.2])
+def test_float16_grid(scale, monkeypatch):
+    n_low = []
+    logit_fn = HalfGaussianConditionalLogit(
+        10000, 10, 'cpu', grid_precision='float16')
+    reference = HalfGaussianConditionalLogit(10000, 10, 'cpu')
+
+    def count(fn):
+        def wrapped(x_r, *args):
+            n_low.append(x_r.shape[0])
+            return fn(x_r, *args)
+        return wrapped
+
+    intersection = logit_fn.ln_intersection_fn.__self__
+    monkeypatch.setattr(intersection, 'sum_low_precision',
+                        count(intersection.sum_low_precision))
+
+    vectors = concept_vectors(24, 50, scale)
+    ln_conditional = logit_fn.ln_conditional(vectors, vectors)[0]
+    ln_reference = reference.ln_conditional(vectors, vectors)[0]
+
+    assert sum(n_low) > 0
+    assert (ln_conditional - ln_reference).abs().max() <= GRID_TOLERANCE
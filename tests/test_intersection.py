@@ -0,0 +1,90 @@
+# Checks of the half-Gaussian intersection backends in
+# models/nn/framework/functional.py
+
+import math
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from models.nn.framework.functional import \
+    HalfGaussianConditionalLogit, get_LnIntersection, ln_cdf_by_integral, \
+    get_LnIntersection_owen
+from models.nn.framework.intersection_table import \
+    build_intersection_table, TABLE_TOLERANCE
+
+
+def ln_tail(x):
+    # ln(Ø(-x))
+    return torch.log(torch.erfc(x / math.sqrt(2)) / 2)
+
+
+def test_quadrature_marginal():
+    # the marginals are integrated at cos == 1
+    x = torch.linspace(0.5, 3, 11).double()
+    fn = get_LnIntersection(10000, 10, 'cpu', False, method='quadrature')
+    ln_marginal = ln_cdf_by_integral(-x, fn)
+    assert (ln_marginal - ln_tail(x)).abs().max() < 1e-2
+
+
+def test_quadrature_identical_vectors():
+    logit_fn = HalfGaussianConditionalLogit(
+        10000, 10, 'cpu', method='quadrature')
+    vectors = torch.randn(4, 5).double()
+    ln_conditional = logit_fn.ln_conditional(vectors, vectors)[0]
+    # Pr(x | x) = 1
+    assert ln_conditional.diagonal().abs().max() < 1e-2
+
+
+def test_quadrature_tune_covers_marginals():
+    logit_fn = HalfGaussianConditionalLogit(
+        10000, 10, 'cpu', method='quadrature', n_nodes=8)
+    vectors = torch.randn(6, 5).double()
+    errors = logit_fn.tune(vectors, vectors, 1e-2)
+    assert logit_fn.error_budget == errors[logit_fn.n_nodes]
+    assert logit_fn.error_budget < 1
+
+
+@pytest.mark.parametrize('method, memory_budget', [
+    ('riemann', 0), ('riemann', 2 ** 16), ('owen', 0), ('quadrature', 0),
+    ('table', 0),
+])
+def test_paired_intersection(method, memory_budget):
+    # the paired call is the diagonal of the cartesian one, gradients too
+    table = None
+    if method == 'table':
+        table = build_intersection_table(
+            3, (9, 9), get_LnIntersection_owen(16, 'cpu', True))
+    logit_fn = HalfGaussianConditionalLogit(
+        10000, 10, 'cpu', method=method, table=table,
+        memory_budget=memory_budget)
+    x_vec = torch.randn(5, 4).double().requires_grad_()
+    y_vec = torch.cat([x_vec[:1].detach(), torch.randn(4, 4).double()])
+
+    ln_pairs = logit_fn.ln_intersection_pairs(x_vec, y_vec)[0]
+    grad_pairs, = torch.autograd.grad(ln_pairs.sum(), x_vec)
+    ln_cartesian = logit_fn.ln_intersection(x_vec, y_vec)[0].diagonal()
+    grad_cartesian, = torch.autograd.grad(ln_cartesian.sum(), x_vec)
+
+    assert torch.allclose(ln_pairs, ln_cartesian)
+    assert torch.allclose(grad_pairs, grad_cartesian)
+
+
+def test_table_near_pi():
+    # ln(Pr) goes to -infinity as the angle goes to π, which the table
+    # should follow between its angles
+    owen = get_LnIntersection_owen(16, 'cpu', True)
+    table = build_intersection_table(5, (41, 65), owen)
+    assert table['error']['value'] <= TABLE_TOLERANCE[0]
+    assert table['error']['cos'] <= TABLE_TOLERANCE[1]
+
+    torch.manual_seed(0)
+    x = torch.rand(2000).double() * 5
+    y = torch.rand(2000).double() * 5
+    angle = math.pi - torch.rand(2000).double().pow(4)
+    cos = angle.cos()[:, None]
+    fn = get_LnIntersection(
+        10000, 10, 'cpu', True, method='table', n_nodes=16, table=table)
+    ln_Pr = fn(x[:, None], y[:, None], cos)
+    reference = owen(x[:, None], y[:, None], cos)
+    error = (ln_Pr - reference).abs() / reference.abs().clamp(min=1)
+    assert error.max() <= 2 * TABLE_TOLERANCE[0]
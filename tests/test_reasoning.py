@@ -0,0 +1,78 @@
+# Checks of the program executor in models/nn/framework/reasoning.py
+
+from types import SimpleNamespace
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from models.nn.framework.reasoning import ProgramExecutor
+
+
+CONCEPTS = {'red': 0, 'cube': 1, 'blue': 2, 'sphere': 3}
+ATTRIBUTES = {'color': 0, 'shape': 1}
+
+
+class Embedding:
+    """
+    A bilinear stand-in for ConceptEmbedding
+    """
+
+    def __init__(self, dim):
+        self.concepts = torch.randn(len(CONCEPTS), dim)
+        self.all_attribute_embeddings = torch.randn(len(ATTRIBUTES), dim)
+        self.heads = torch.randn(5)
+
+    def concept_embedding(self, indexes):
+        return self.concepts[indexes]
+
+    def get_embedding(self, category, name):
+        return self.concepts[CONCEPTS[name]]
+
+    def determine_relation(self, concepts1, concepts2, detach=(True, True)):
+        similarity = torch.matmul(concepts1, concepts2.t()) \
+            if concepts2.dim() > 1 else torch.matmul(concepts1, concepts2)
+        return similarity[..., None] * self.heads
+
+    def determine_relation_pairs(self, concepts1, concepts2,
+                                 detach=(True, True)):
+        return (concepts1 * concepts2).sum(1)[:, None] * self.heads
+
+
+def op(operation, argument=None):
+    return {'operation': operation, 'argument': argument}
+
+
+def test_forward_batch_matches_forward():
+    torch.manual_seed(0)
+    args = SimpleNamespace(
+        not_build_reasoning=False, detach_in_rel=True, conceptual_weight=1)
+    tools = SimpleNamespace(concepts=CONCEPTS, attributes=ATTRIBUTES)
+    executor = ProgramExecutor(args, tools, 'cpu')
+    embedding = Embedding(6)
+
+    exist = [op('select_object'), op('filter', 'red'), op('exist'),
+             op('<END>')]
+    unique = [op('select_object'), op('filter', 'cube'),
+              op('unique_object'), op('isinstanceof'), op('<END>')]
+    synonym = [op('select_concept', 'red'), op('synonym', 'blue')]
+    programs = [exist, unique, synonym, unique, exist]
+    answers = ['yes', 'color', 'no', 'shape', 'no']
+    cats = ['visual', 'visual', 'conceptual', 'visual', 'visual']
+    objects = [torch.randn(n, 6) for n in (3, 4, 1, 2, 5)]
+    logits = [
+        [None, torch.randn(one.shape[0])] + [None] * (len(program) - 2)
+        for one, program in zip(objects, programs)
+    ]
+
+    batched = executor.forward_batch(
+        programs, answers, cats, objects, logits, embedding)
+    for i in range(len(programs)):
+        loss, output, _ = executor(
+            programs[i], answers[i], cats[i], objects[i], logits[i],
+            embedding)
+        # the serial call is informative, i.e. did not fail
+        assert output != {'yes': 0.5, 'no': 0.5}
+        assert torch.allclose(batched[i][0], loss, atol=1e-5)
+        for key in output:
+            assert torch.allclose(torch.as_tensor(batched[i][1][key]),
+                                  torch.as_tensor(output[key]), atol=1e-5)
@@ -0,0 +1,35 @@
+# Checks of models/model/vcml_model.py
+
+from types import SimpleNamespace
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('sklearn')
+pytest.importorskip('jactorch')
+
+from models.model.vcml_model import VCML_Model
+
+
+def test_feature_mlp_once_per_scene_graph():
+    # samples 0, 1 and 3 are questions on the same image
+    shared = (None, torch.randn(3, 4), None)
+    other = (None, torch.randn(2, 4), None)
+    recognized = [shared, shared, other, shared, (None, None, None)]
+    calls = []
+
+    def feature_mlp(feature):
+        calls.append(feature)
+        return feature * 2
+
+    model = SimpleNamespace(
+        feature_mlp=feature_mlp,
+        object_cache=None,
+        resnet_model=lambda data, cache: (None, None, recognized),
+    )
+    data = {'batch_size': 5, 'object_length': [3, 3, 2, 3, 0]}
+    objects = VCML_Model.process_objects(model, data)
+
+    assert len(calls) == 2
+    assert objects[0] is objects[1] and objects[1] is objects[3]
+    assert torch.equal(objects[2], other[1] * 2)
+    assert objects[4] is None
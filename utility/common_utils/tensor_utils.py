@@ -32,6 +32,8 @@ def to_tensor(x):
     elif isinstance(x, np.ndarray):
         if x.dtype.char in ['d', 'f']:
             return torch.Tensor(x)
+        elif x.dtype.char == 'e':
+            return torch.from_numpy(x)
         elif x.dtype.char in ['l', 'b']:
             return torch.LongTensor(x)
         else:
@@ -78,6 +78,6 @@ def download_ckpt(args, task, name, index, is_main=True):
         os.system(f'wget {ckpt_link} -P {temp_dir}')
     else:
         os.system(f'wget -q {ckpt_link} -P {temp_dir}')
-    ckpt = torch.load(ckpt_file)
+    ckpt = torch.load(ckpt_file, map_location='cpu')
     os.system(f'rm {ckpt_file}')
     return ckpt